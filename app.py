@@ -1,241 +1,152 @@
 from flask import Flask, request, abort, jsonify, render_template
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
-from linebot.models import MessageEvent, TextMessage, TextSendMessage, ImageMessage, FlexSendMessage, PostbackEvent
+from linebot.models import MessageEvent, TextMessage, TextSendMessage, ImageMessage, PostbackEvent
 import os
-import io
+import random
+import contextvars
+from urllib.parse import parse_qsl
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from firebase_service import initialize_firebase, save_recipe_to_db, get_recipe_from_db, get_user_favorites, delete_favorite_from_db
+from firebase_service import get_db, write_executor, save_recipes_batch, get_recipe_from_db, get_user_favorites, get_favorite_from_db, save_favorite_to_db, delete_favorite_from_db, FAVORITE_LIST_FIELDS
 from google_vision_service import detect_labels
-from chatgpt_service import translate_and_filter_ingredients, generate_recipe_response
+from chatgpt_service import translate_and_filter_ingredients, generate_recipe_response, generate_recipes_batch
+from job_queue import job_queue
+from recipe_index import load_recipe_index
+from session_store import favorites_cache, favorites_page_key, invalidate_favorites_cache
+from image_preprocessing import read_message_content, preprocess_image
+from client_manager import clients, WarmUp
+from metrics import metrics, stage, start_trace
+from cache_service import get_cache_stats
+from recipe_cache import get_generation_cache_stats
+from chatgpt_service import openai_policy
+from google_vision_service import vision_policy
+import bot_flow
+from bot_flow import BotIO, run_sync
 
 # 載入環境變數
 load_dotenv()
 app = Flask(__name__)
 
-# 初始化 Firebase
-db = initialize_firebase()
+# 在背景執行緒中建立 Firebase、Vision 與 OpenAI 的共用客戶端並載入本地食譜索引，不阻塞啟動
+# 完成前收到的請求會在第一次使用時自行建立客戶端；/ready 回報是否已全部完成
+startup = WarmUp([
+    ("firestore", lambda: clients.get("firestore")),
+    ("vision", lambda: clients.get("vision")),
+    ("openai", lambda: clients.get("openai")),
+    ("recipe_index", lambda: load_recipe_index(get_db())),
+])
+# 以 gunicorn --preload 啟動時 master 不執行，改由 worker 在 post_worker_init 中啟動（見 gunicorn.conf.py）
+if os.getenv("WARM_UP_ON_IMPORT", "1") == "1":
+    startup.start()
 
 # LINE Bot API 和 Webhook 設定
 line_bot_api = LineBotApi(os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
 handler = WebhookHandler(os.getenv("LINE_CHANNEL_SECRET"))
 
+# 並行生成多道食譜的執行緒池
+recipe_executor = ThreadPoolExecutor(max_workers=int(os.getenv("RECIPE_MAX_WORKERS", 5)))
+
+# 事件在背景工作佇列中處理，reply token 可能已過期，因此一律以 push_message 傳送結果
+def send_message(event, messages):
+    with stage("push"):
+        line_bot_api.push_message(event.source.user_id, messages)
+
+# 串流生成時先推播正在準備的料理名稱
+def notify_preparing(event, dish_name):
+    send_message(event, TextSendMessage(text=f"正在為您準備：{dish_name}"))
+
+
+# 在呼叫端 context 的複本中執行 coroutine function，讓執行緒池中的各階段紀錄沿用同一個 trace ID
+# 每個工作各自複製一份，同一個 context 不能同時在多個執行緒中執行
+def in_context(func):
+    context = contextvars.copy_context()
+    return lambda: context.run(lambda: run_sync(func()))
+
+
+# 同步模式的 I/O：直接呼叫阻塞的服務函式，處理流程見 bot_flow
+class SyncBotIO(BotIO):
+    async def call(self, func, *args):
+        return func(*args)
+
+    async def send_message(self, event, messages):
+        send_message(event, messages)
+
+    def notify_preparing(self, event, dish_name):
+        notify_preparing(event, dish_name)
+
+    async def download_image(self, message_id):
+        return read_message_content(line_bot_api.get_message_content(message_id))
+
+    async def preprocess_image(self, image_content):
+        image_content, _ = preprocess_image(image_content)
+        return image_content
+
+    async def detect_labels(self, image_content):
+        return detect_labels(image_content)
+
+    async def translate_ingredients(self, labels):
+        return translate_and_filter_ingredients(labels)
+
+    async def generate_recipe(self, dish_type, ingredients, exclude_dishes, on_dish_name=None):
+        return generate_recipe_response(dish_type, 1, ingredients, exclude_dishes, on_dish_name=on_dish_name)
+
+    async def generate_recipes_batch(self, dish_type, count, ingredients, exclude_dishes):
+        return generate_recipes_batch(dish_type, count, ingredients, exclude_dishes)
+
+    async def run_concurrently(self, funcs):
+        tasks = [in_context(func) for func in funcs]
+        return list(recipe_executor.map(lambda task: task(), tasks))
+
+    # 在 Firestore 的背景寫入執行緒池中執行，讓回覆訊息不必等待資料庫寫入完成
+    def run_in_background(self, func):
+        write_executor.submit(in_context(func))
+
+    async def get_db(self):
+        return get_db()
+
+    async def get_recipe(self, db, recipe_id):
+        return get_recipe_from_db(db, recipe_id)
+
+    async def save_recipes_batch(self, db, user_id, recipes, dish_type):
+        return save_recipes_batch(db, user_id, recipes, dish_type)
+
+    async def save_favorite(self, db, user_id, recipe_id, recipe):
+        return save_favorite_to_db(db, user_id, recipe_id, recipe)
+
+bot_io = SyncBotIO()
+
 # 處理圖片訊息，進行 Google Cloud Vision 的物體偵測（Label Detection）
 @handler.add(MessageEvent, message=ImageMessage)
 def handle_image_message(event):
-    message_id = event.message.id
-    message_content = line_bot_api.get_message_content(message_id)
-
-    # 讀取圖片內容
-    image_data = io.BytesIO(message_content.content)
-
-    # 使用封裝的 detect_labels 方法
-    detected_labels = detect_labels(image_data.read())
-
-    if detected_labels:
-        print(f"辨識到的食材: {detected_labels}")  # 在 log 中顯示食材
-        processed_text = translate_and_filter_ingredients(detected_labels)
-        user_id = event.source.user_id
-        if processed_text:
-            user_ingredients[user_id] = processed_text
-            question_response = ask_user_for_recipe_info()
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=question_response)
-            )
-        else:
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="未能識別出任何食材，請嘗試上傳另一張清晰的圖片。")
-            )
-    else:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="無法辨識出任何物體，請確保圖片中的食材明顯可見。")
-        )
-
-# 儲存處理後的食材資料（供後續使用）
-user_ingredients = {}
-
-# 問使用者料理需求
-def ask_user_for_recipe_info():
-    return "您今天想做甚麼樣的料理？幾道菜？"
-
-import re
-def clean_text(text):
-    # 去除無效字符和表情符號
-    return re.sub(r'[^\w\s,.!?]', '', text)
-def create_flex_message(recipe_text, user_id, dish_name, ingredient_text, ingredients, recipe_number):
-    recipe_id = save_recipe_to_db(db, user_id, dish_name, recipe_text, ingredient_text)
-    if isinstance(ingredients, list):
-        ingredients_str = ','.join(ingredients)
-    else:
-        ingredients_str = str(ingredients)
-    # 設置 Flex Message 結構
-    bubble = {
-        "type": "bubble",
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {"type": "text", "text": f"料理名稱 {recipe_number}：{dish_name}", "wrap": True, "weight": "bold", "size": "xl"},
-                {"type": "text", "text": f"食材：{ingredient_text}", "wrap": True, "margin": "md", "size": "sm"},
-                {"type": "text", "text": "食譜內容：", "wrap": True, "weight": "bold", "size": "lg", "margin": "md"},
-                {"type": "text", "text": recipe_text if recipe_text else "食譜內容缺失", "wrap": True, "margin": "md", "size": "sm"}
-            ]
-        },
-        "footer": {
-            "type": "box",
-            "layout": "vertical",
-            "spacing": "sm",
-            "contents": [
-                {"type": "button", "action": {"type": "postback", "label": "其他食譜", "data":f"action=new_recipe&user_id={user_id}&ingredients={ingredients_str}"},
-                 "color": "#474242", "style": "primary", "height": "sm"},
-                {"type": "button", "action": {"type": "postback", "label": "加入我的最愛", "data":f"action=save_favorite&recipe_id={recipe_id}"},
-                 "color": "#474242", "style": "primary", "height": "sm"}
-            ]
-        }
-    }
-    return bubble
-
-# 提取料理類型和菜數
-def parse_user_message(user_message):
-    match = re.search(r"做(.*?)(?:幾|道)?", user_message)
-    dish_type = match.group(1).strip() if match else "料理"
-
-    dish_count = None
-    if re.search(r"\d+", user_message):
-        dish_count = int(re.search(r"\d+", user_message).group())
-    else:
-        dish_count = chinese_to_digit(user_message)
-
-    return dish_type, dish_count if dish_count else 1
+    run_sync(bot_flow.handle_image_message(bot_io, event))
 
 # 處理使用者需求
 @handler.add(PostbackEvent)
 def handle_postback(event):
-    data = event.postback.data
-    params = dict(x.split('=') for x in data.split('&'))
-    action = params.get('action')
-    user_id = params.get('user_id')
-    # 修改 handle_postback 函數中的 `new_recipe` 行動回應
-    if action == 'new_recipe':
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="沒問題，請稍後~")
-        )
-        try:
-            ingredients_str = params.get('ingredients', '')
-            ingredients = ingredients_str.split(',') if ingredients_str else []
-        
-            # 调用 generate_recipe_response
-            dish_name, ingredient_text, recipe_text = generate_recipe_response("新的食譜", 1, ingredients)
-        
-            if dish_name and recipe_text:
-                flex_message = FlexSendMessage(
-                    alt_text="您的新食譜",
-                    contents=create_flex_message(recipe_text, user_id, dish_name, ingredient_text, ingredients, 1)
-                )
-                line_bot_api.push_message(user_id, flex_message)
-            else:
-                line_bot_api.push_message(
-                    user_id,
-                    TextSendMessage(text="生成食譜失敗，請稍後再試。")
-                )
-        except Exception as e:
-            print(f"生成食譜時發生錯誤: {e}")
-            line_bot_api.push_message(
-                user_id,
-                TextSendMessage(text="生成食譜時出現問題，請稍後再試。")
-            )
-    elif action == 'save_favorite':
-        recipe_id = params.get('recipe_id')    
-        user_id = user_id or event.source.user_id  # 確保 user_id 不為 null
-        recipe = get_recipe_from_db(db, recipe_id)
-        if recipe:
-            # 將該食譜儲存在 favorites 集合中
-            try:
-                db.collection('favorites').add({
-                    'user_id': user_id,  # 確保此處使用了正確的 user_id
-                    'dish': recipe['dish'],
-                    'ingredient': recipe['ingredient'],
-                    'recipe': recipe['recipe'],
-                    'recipe_id': recipe_id
-                })
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text="已成功將食譜加入我的最愛!")
-                )
-            except Exception as e:
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text="抱歉，儲存過程中發生錯誤。")
-                )
-        else:
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="找不到該食譜，無法加入我的最愛")
-            )
-def generate_multiple_recipes(dish_count, dish_type, ingredients):
-    recipes = []
-    existing_dishes = set()  # 用於追踪生成的菜名，避免重複
-
-    for _ in range(dish_count):
-        while True:
-            # 生成食譜
-            dish_name, ingredient_text, recipe_text = generate_recipe_response(dish_type, 1, ingredients)
-
-            # 如果食譜不重複，則加入清單並跳出迴圈
-            if dish_name not in existing_dishes:
-                recipes.append((dish_name, ingredient_text, recipe_text))
-                existing_dishes.add(dish_name)
-                break
-            else:
-                print("生成的食譜重複，重新生成...")
-    return recipes
-
-# 將中文數字轉換為阿拉伯數字的函數
-def chinese_to_digit(user_message):
-    chinese_digits = {'零': 0, '一': 1, '二': 2, '兩': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
-    chinese_num = re.search(r"[零一二兩三四五六七八九]", user_message)
-    if chinese_num:
-        return chinese_digits[chinese_num.group()]
-    return None
-
-# 更新 handle_message 函數
+    params = dict(parse_qsl(event.postback.data))
+    run_sync(bot_flow.handle_postback(bot_io, event, params))
+
+# 依使用者指定的料理類型與數量回覆多道食譜
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
-    user_id = event.source.user_id
-    user_message = event.message.text
-    # 解析使用者訊息
-    dish_type, dish_count = parse_user_message(user_message)
-    ingredients = user_ingredients.get(user_id, None)
-    if ingredients:
-        # 生成多道食譜
-        recipes = generate_multiple_recipes(dish_count, dish_type, ingredients)
-        # 回覆多頁式的食譜 Flex Message
-        flex_bubbles = [
-            create_flex_message(recipe_text, user_id, dish_name, ingredient_text, ingredients, i + 1)
-            for i, (dish_name, ingredient_text, recipe_text) in enumerate(recipes)
-        ]
-        carousel = {
-            "type": "carousel",
-            "contents": flex_bubbles
-        }
-        line_bot_api.reply_message(
-            event.reply_token, 
-            FlexSendMessage(alt_text="您的多道食譜", contents=carousel)
-        )
-    else:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="請先上傳圖片來辨識食材。")
-        )
-        
+    run_sync(bot_flow.handle_message(bot_io, event))
+
 # 顯示收藏的食譜（前端頁面）
 @app.route('/favorites')
 def favorites_page():
     return render_template('favorites.html')
+# 收藏列表的分頁大小；分頁的回應快取見 session_store.favorites_cache
+FAVORITES_PAGE_SIZE = int(os.getenv("FAVORITES_PAGE_SIZE", 20))
+FAVORITES_MAX_PAGE_SIZE = 100
+
+# 回傳 JSON 並附上 ETag，用戶端帶 If-None-Match 且內容未變時回 304
+def conditional_json(data):
+    response = jsonify(data)
+    response.add_etag()
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
 @app.route('/api/favorites', methods=['GET'])
 def get_user_favorites_api():
     try:
@@ -243,10 +154,28 @@ def get_user_favorites_api():
         user_id = request.args.get('user_id')  # 前端需要傳遞 user_id 作為參數
         if not user_id:
             return jsonify({'error': 'User ID is required'}), 400
-        # 從 Firestore 獲取用戶收藏的食譜
-        favorites = get_user_favorites(db, user_id)
+        limit = request.args.get('limit', FAVORITES_PAGE_SIZE, type=int) or FAVORITES_PAGE_SIZE
+        limit = max(1, min(limit, FAVORITES_MAX_PAGE_SIZE))
+        start_after = request.args.get('start_after')
+
+        # 各分頁各自快取，失效時換掉使用者的世代，所有舊分頁一起作廢
+        # 在讀取 Firestore 之前決定 key，期間發生的失效會換掉世代，這次寫回的分頁不會再被讀到
+        page_key = favorites_page_key(user_id, limit, start_after)
+        cached = favorites_cache.get(page_key)
+        if cached is not None:
+            return conditional_json(cached)
+
+        # 從 Firestore 獲取用戶收藏的食譜（多讀一筆以判斷是否還有下一頁，列表不含完整食譜內容）
+        favorites = get_user_favorites(get_db(), user_id, limit=limit + 1, start_after=start_after, fields=FAVORITE_LIST_FIELDS)
         if favorites is not None:
-            return jsonify(favorites), 200
+            has_more = len(favorites) > limit
+            favorites = favorites[:limit]
+            data = {
+                'favorites': favorites,
+                'next_cursor': favorites[-1]['id'] if has_more else None
+            }
+            favorites_cache.set(page_key, data)
+            return conditional_json(data)
         else:
             return jsonify({'error': 'Failed to retrieve favorites'}), 500
     except Exception as e:
@@ -255,7 +184,7 @@ def get_user_favorites_api():
         
 # 使用 `get_recipe_from_db`
 def handle_get_recipe(recipe_id):
-    recipe = get_recipe_from_db(db, recipe_id)
+    recipe = get_recipe_from_db(get_db(), recipe_id)
     if recipe:
         print(f"查詢成功: {recipe}")
     else:
@@ -264,9 +193,13 @@ def handle_get_recipe(recipe_id):
 @app.route('/api/favorites/<recipe_id>', methods=['DELETE'])
 def delete_recipe(recipe_id):
     print(f"收到刪除請求，recipe_id: {recipe_id}")
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'User ID is required'}), 400
     try:
-        if delete_favorite_from_db(db, recipe_id):
+        if delete_favorite_from_db(get_db(), user_id, recipe_id):
             print("食譜成功刪除")
+            invalidate_favorites_cache(user_id)
             return jsonify({'message': '食譜已成功刪除！'}), 200
         else:
             print("刪除失敗，找不到對應的食譜")
@@ -274,18 +207,18 @@ def delete_recipe(recipe_id):
     except Exception as e:
         print(f"刪除過程中發生錯誤: {str(e)}")
         return jsonify({'error': f'發生錯誤：{str(e)}'}), 500
-    # 直接返回收藏頁面
-    favorites = get_user_favorites(db, user_id)  # 替換成實際的 user_id
-    return render_template('favorites.html', favorites=favorites, message=message)
 
 
 # 顯示特定食譜的詳細內容 (供 "查看更多" 使用)
 @app.route('/api/favorites/<recipe_id>', methods=['GET'])
 def get_recipe_detail(recipe_id):
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'User ID is required'}), 400
     try:
-        recipe_doc = db.collection('favorites').document(recipe_id).get()
-        if recipe_doc.exists:
-            return jsonify(recipe_doc.to_dict()), 200
+        favorite = get_favorite_from_db(get_db(), user_id, recipe_id)
+        if favorite:
+            return conditional_json(favorite)
         else:
             return jsonify({'error': 'Recipe not found'}), 404
     except Exception as e:
@@ -299,27 +232,68 @@ def fetch_labels():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# 依比例抽樣輸出完整的 webhook 內容以便除錯，預設不輸出（內容包含使用者 ID 與訊息）
+WEBHOOK_LOG_SAMPLE_RATE = float(os.getenv("WEBHOOK_LOG_SAMPLE_RATE", 0))
+
+def log_webhook_body(body):
+    if random.random() < WEBHOOK_LOG_SAMPLE_RATE:
+        print(f"收到 Webhook 請求: Body: {body}")
+
+# 在背景工作中處理一次 webhook，同一次處理的各階段共用 trace ID
+def handle_webhook(body, signature):
+    start_trace()
+    with stage("webhook"):
+        handler.handle(body, signature)
+
 # Webhook callback 處理 LINE 訊息
 @app.route("/callback", methods=["POST"])
 def callback():
     body = request.get_data(as_text=True)
-    print(f"收到 Webhook 請求: Body: {body}")
+    log_webhook_body(body)
     try:
         signature = request.headers["X-Line-Signature"]
-        handler.handle(body, signature)
+        # 只在請求中驗證簽名，事件交給背景工作佇列處理後立即回應 LINE
+        if not handler.parser.signature_validator.validate(body, signature):
+            raise InvalidSignatureError(f"Invalid signature. signature={signature}")
+        queued = job_queue.submit(handle_webhook, body, signature)
     except InvalidSignatureError:
         print("無效的簽名錯誤!")
         abort(400)
     except Exception as e:
         print(f"發生錯誤: {str(e)}")
         abort(500)
+    if not queued:
+        abort(503)
     return "OK"
     
-# 健康檢查路由
+# Prometheus 格式的統計：各階段耗時、token 用量、重新生成次數，以及快取、工作佇列與對外呼叫的狀態
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    gauges = []
+    for cache in get_cache_stats():
+        for key in ('size', 'hits', 'misses', 'evictions'):
+            gauges.append((f"foodlens_cache_{key}", {'cache': cache['name']}, cache[key]))
+    for key, value in job_queue.stats().items():
+        gauges.append((f"foodlens_job_queue_{key}", {}, value))
+    for policy in (openai_policy, vision_policy):
+        stats = policy.get_stats()
+        gauges.append(("foodlens_outbound_circuit_open", {'service': policy.name}, int(stats.pop('breaker_state') != 'closed')))
+        for key, value in stats.items():
+            gauges.append((f"foodlens_outbound_{key}", {'service': policy.name}, value))
+    for key, value in get_generation_cache_stats().items():
+        gauges.append((f"foodlens_generation_cache_{key}", {}, value))
+    return metrics.render(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# 健康檢查路由：只確認程序存活，不等待外部服務
 @app.route("/health", methods=["GET"])
 def health_check():
     return "OK", 200
 
+# 就緒檢查：背景啟動工作全部完成後才回傳 200，供負載平衡器決定是否導入流量
+@app.route("/ready", methods=["GET"])
+def readiness_check():
+    return jsonify(startup.status()), 200 if startup.is_ready() else 503
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,211 @@
+import os
+import asyncio
+from urllib.parse import parse_qsl
+import aiohttp
+from asgiref.wsgi import WsgiToAsgi
+from linebot import AsyncLineBotApi, WebhookParser
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import MessageEvent, TextMessage, TextSendMessage, ImageMessage, PostbackEvent
+from app import app, log_webhook_body
+from firebase_service import (
+    prepare_async_firestore, initialize_async_firestore, save_recipes_batch_async, get_recipe_from_db_async, save_favorite_to_db_async
+)
+from google_vision_service import prepare_vision_async_client, initialize_vision_async_client, detect_labels_async
+from chatgpt_service import translate_and_filter_ingredients_async, generate_recipe_response_async, generate_recipes_batch_async
+from image_preprocessing import read_message_content_async, preprocess_image
+from client_manager import ClientManager, clients
+from metrics import stage, start_trace
+import bot_flow
+from bot_flow import BotIO
+
+# ASGI 進入點：LINE、OpenAI、Vision 與 Firestore 都改用非同步客戶端，
+# 單一程序即可同時服務大量正在等待 I/O 的對話；/callback 以外的路由（收藏 API 等）沿用 Flask app
+# 啟動方式：uvicorn asgi_app:application --host 0.0.0.0 --port $PORT
+
+# 同時處理中的事件上限，超過時回應 503 讓 LINE 重送
+ASYNC_MAX_EVENTS = int(os.getenv("ASYNC_MAX_EVENTS", 500))
+# 關閉時等待處理中事件完成的秒數
+ASYNC_SHUTDOWN_TIMEOUT = float(os.getenv("ASYNC_SHUTDOWN_TIMEOUT", 30))
+
+parser = WebhookParser(os.getenv("LINE_CHANNEL_SECRET"))
+
+# 非同步客戶端綁定在事件迴圈上，因此與同步模式的 clients 分開管理，只在第一次使用時建立
+async_clients = ClientManager()
+async_clients.register("vision", initialize_vision_async_client)
+async_clients.register("firestore", initialize_async_firestore)
+# 建立前會阻塞的準備工作（匯入 SDK、寫入憑證檔、初始化 Firebase Admin SDK）交給執行緒
+async_client_preparers = {"vision": prepare_vision_async_client, "firestore": prepare_async_firestore}
+
+http_session = None
+line_bot_api = None
+# 保留背景 task 的參考，避免執行中被回收
+tasks = set()
+
+def get_line_bot_api():
+    global http_session, line_bot_api
+    if line_bot_api is None:
+        http_session = aiohttp.ClientSession()
+        line_bot_api = AsyncLineBotApi(
+            os.getenv("LINE_CHANNEL_ACCESS_TOKEN"), async_http_client=AiohttpAsyncHttpClient(http_session)
+        )
+    return line_bot_api
+
+async def get_async_client(name):
+    if not async_clients.is_ready(name):
+        await asyncio.to_thread(async_client_preparers[name])
+    return async_clients.get(name)
+
+def spawn(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+# 與同步模式相同，一律以 push_message 傳送結果
+async def send_message(event, messages):
+    with stage("push"):
+        await get_line_bot_api().push_message(event.source.user_id, messages)
+
+
+# 非同步模式的 I/O：LINE、OpenAI、Vision 與 Firestore 使用非同步客戶端，
+# 快取與 session store（可能是 sqlite）以及 CPU 工作交給執行緒，處理流程見 bot_flow
+class AsyncBotIO(BotIO):
+    async def call(self, func, *args):
+        return await asyncio.to_thread(func, *args)
+
+    async def send_message(self, event, messages):
+        await send_message(event, messages)
+
+    # 串流回呼是同步呼叫，推播交給背景 task
+    def notify_preparing(self, event, dish_name):
+        spawn(send_message(event, TextSendMessage(text=f"正在為您準備：{dish_name}")))
+
+    async def download_image(self, message_id):
+        message_content = await get_line_bot_api().get_message_content(message_id)
+        return await read_message_content_async(message_content)
+
+    async def preprocess_image(self, image_content):
+        image_content, _ = await asyncio.to_thread(preprocess_image, image_content)
+        return image_content
+
+    async def detect_labels(self, image_content):
+        return await detect_labels_async(await get_async_client("vision"), image_content)
+
+    async def translate_ingredients(self, labels):
+        return await translate_and_filter_ingredients_async(labels)
+
+    async def generate_recipe(self, dish_type, ingredients, exclude_dishes, on_dish_name=None):
+        return await generate_recipe_response_async(dish_type, 1, ingredients, exclude_dishes, on_dish_name=on_dish_name)
+
+    async def generate_recipes_batch(self, dish_type, count, ingredients, exclude_dishes):
+        return await generate_recipes_batch_async(dish_type, count, ingredients, exclude_dishes)
+
+    async def run_concurrently(self, funcs):
+        return await asyncio.gather(*(func() for func in funcs))
+
+    def run_in_background(self, func):
+        spawn(func())
+
+    async def get_db(self):
+        return await get_async_client("firestore")
+
+    async def get_recipe(self, db, recipe_id):
+        return await get_recipe_from_db_async(db, recipe_id)
+
+    async def save_recipes_batch(self, db, user_id, recipes, dish_type):
+        return await save_recipes_batch_async(db, user_id, recipes, dish_type)
+
+    async def save_favorite(self, db, user_id, recipe_id, recipe):
+        return await save_favorite_to_db_async(db, user_id, recipe_id, recipe)
+
+bot_io = AsyncBotIO()
+
+# 依事件類型分派，對應 app.py 中以 handler.add 註冊的處理函式
+async def handle_event(event):
+    # OpenAI 的非同步呼叫共用同一個 aiohttp session（contextvar，需在每個 task 中設定）
+    get_line_bot_api()
+    # 第一次使用時 import openai 會阻塞，交給執行緒
+    if not clients.is_ready("openai"):
+        await asyncio.to_thread(clients.get, "openai")
+    clients.get("openai").aiosession.set(http_session)
+    start_trace()
+    try:
+        with stage("webhook"):
+            await dispatch_event(event)
+    except Exception as e:
+        print(f"處理事件時發生錯誤: {e}")
+
+async def dispatch_event(event):
+    if isinstance(event, MessageEvent) and isinstance(event.message, ImageMessage):
+        await bot_flow.handle_image_message(bot_io, event)
+    elif isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        await bot_flow.handle_message(bot_io, event)
+    elif isinstance(event, PostbackEvent):
+        await bot_flow.handle_postback(bot_io, event, dict(parse_qsl(event.postback.data)))
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def send_response(send, status, text):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'text/plain; charset=utf-8')]
+    })
+    await send({'type': 'http.response.body', 'body': text.encode('utf-8')})
+
+# Webhook callback：驗證簽名後將事件交給背景 task，立即回應 LINE
+async def callback(scope, receive, send):
+    body = (await read_body(receive)).decode('utf-8')
+    log_webhook_body(body)
+    headers = dict(scope['headers'])
+    signature = headers.get(b'x-line-signature', b'').decode('utf-8')
+    try:
+        events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        print("無效的簽名錯誤!")
+        await send_response(send, 400, "Bad Request")
+        return
+    except Exception as e:
+        print(f"發生錯誤: {str(e)}")
+        await send_response(send, 500, "Internal Server Error")
+        return
+    if len(tasks) + len(events) > ASYNC_MAX_EVENTS:
+        await send_response(send, 503, "Service Unavailable")
+        return
+    for event in events:
+        spawn(handle_event(event))
+    await send_response(send, 200, "OK")
+
+async def shutdown():
+    if tasks:
+        await asyncio.wait(set(tasks), timeout=ASYNC_SHUTDOWN_TIMEOUT)
+    if http_session is not None:
+        await http_session.close()
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            get_line_bot_api()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+flask_app = WsgiToAsgi(app)
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http' and scope['path'] == '/callback' and scope['method'] == 'POST':
+        await callback(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
@@ -0,0 +1,566 @@
+import os
+import json
+import time
+import uuid
+import base64
+import hmac
+import hashlib
+import random
+import argparse
+import threading
+import zlib
+from collections import defaultdict
+
+# 離線壓力測試：以假的 LINE、OpenAI、Vision 與 Firestore 取代外部服務，將 webhook 事件重播到 callback()
+# 不需要任何金鑰或網路，例如：
+#   python benchmark.py --users 20 --openai-latency 3 --openai-error-rate 0.05
+#   python benchmark.py --events recorded.jsonl   （每行一個 webhook body）
+# 回報吞吐量、端到端延遲的 p50/p95/p99、各 handler 的耗時，以及各階段的平均耗時
+
+CHANNEL_SECRET = "benchmark-secret"
+
+LABEL_POOL = [
+    "Tomato", "Egg", "Onion", "Garlic", "Potato", "Carrot", "Cabbage", "Tofu", "Chicken", "Pork",
+    "Beef", "Mushroom", "Green onion", "Bell pepper", "Rice", "Noodle", "Food", "Ingredient",
+    "Vegetable", "Tableware", "Cutting board", "Produce", "Recipe", "Cuisine",
+]
+LABEL_TRANSLATIONS = {
+    "Tomato": "番茄", "Egg": "雞蛋", "Onion": "洋蔥", "Garlic": "蒜", "Potato": "馬鈴薯", "Carrot": "胡蘿蔔",
+    "Cabbage": "高麗菜", "Tofu": "豆腐", "Chicken": "雞肉", "Pork": "豬肉", "Beef": "牛肉", "Mushroom": "香菇",
+    "Green onion": "青蔥", "Bell pepper": "甜椒", "Rice": "白飯", "Noodle": "麵條",
+}
+DISH_TYPES = ["中式", "日式", "西式", "韓式", "泰式", "家常"]
+COUNT_WORDS = ["一道", "兩道", "三道", "2 道", "3道"]
+
+
+# 模擬外部服務的延遲與錯誤：延遲為以 latency 為中位數的對數常態分佈，依 error_rate 機率拋出錯誤
+class FakeBackend:
+    def __init__(self, latency=0.0, sigma=0.5, error_rate=0.0, error_factory=Exception):
+        self.latency = latency
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.error_factory = error_factory
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def delay(self):
+        return self.latency * random.lognormvariate(0, self.sigma) if self.latency > 0 else 0
+
+    def call(self, duration=None):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay() if duration is None else duration)
+        if self.error_rate and random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            raise self.error_factory("benchmark 模擬錯誤")
+
+
+class FakeContent:
+    def __init__(self, data):
+        self.data = data
+
+    def iter_content(self, chunk_size=1024):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+
+# 取代 LineBotApi：記錄每位使用者收到的訊息，get_message_content 回傳產生的圖片
+class FakeLineBotApi:
+    def __init__(self, backend, images):
+        self.backend = backend
+        self.images = images
+        self.pushed = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def push_message(self, to, messages):
+        self.backend.call()
+        messages = messages if isinstance(messages, list) else [messages]
+        with self._lock:
+            self.pushed[to].extend(messages)
+
+    def reply_message(self, reply_token, messages):
+        self.backend.call()
+
+    def get_message_content(self, message_id):
+        self.backend.call()
+        return FakeContent(self.images[zlib.crc32(message_id.encode()) % len(self.images)])
+
+    def last_flex(self, user_id):
+        with self._lock:
+            for message in reversed(self.pushed[user_id]):
+                if getattr(message, 'type', None) == 'flex':
+                    return message.as_json_dict()
+        return None
+
+
+# 取代 vision.ImageAnnotatorClient：依圖片內容決定回傳的標籤
+class FakeVisionClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def label_detection(self, image=None, timeout=None):
+        self.backend.call()
+        seed = int(hashlib.md5(image.content).hexdigest()[:8], 16)
+        labels = random.Random(seed).sample(LABEL_POOL, 8)
+        return Struct(error=Struct(message=''), label_annotations=[Struct(description=label) for label in labels])
+
+
+class Struct:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+# 取代 openai.ChatCompletion.create：依 prompt 回傳翻譯結果、單道或多道食譜，支援串流
+class FakeOpenAI:
+    def __init__(self, backend, separator, duplicate_rate=0.0, tokens_per_second=50.0):
+        self.backend = backend
+        self.separator = separator
+        self.duplicate_rate = duplicate_rate
+        self.tokens_per_second = tokens_per_second
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _dish_name(self, dish_type):
+        with self._lock:
+            if self._counter and random.random() < self.duplicate_rate:
+                number = self._counter
+            else:
+                self._counter += 1
+                number = self._counter
+        return f"{dish_type}料理{number}號"
+
+    def _recipe(self, dish_type, ingredients):
+        return (
+            f"料理名稱: {self._dish_name(dish_type)}\n"
+            f"食材: {ingredients}、鹽、醬油\n"
+            f"食譜內容:\n1. 將食材洗淨切好。\n2. 熱鍋下油，依序放入食材拌炒。\n3. 加入調味料調味後即可起鍋。"
+        )
+
+    def _content(self, messages):
+        system, prompt = messages[0]['content'], messages[-1]['content']
+        if "翻譯" in system:
+            labels = prompt.split('\n')[1].split(', ')
+            return '、'.join(LABEL_TRANSLATIONS[label] for label in labels if label in LABEL_TRANSLATIONS) or "無"
+        dish_type = prompt.split("做 ", 1)[-1].split(" 料理", 1)[0]
+        ingredients = prompt.split("食材：", 1)[-1].split("。", 1)[0]
+        if self.separator in prompt:
+            count = int(prompt.split("請生成 ", 1)[-1].split(" 道", 1)[0])
+            return f"\n{self.separator}\n".join(self._recipe(dish_type, ingredients) for _ in range(count))
+        return self._recipe(dish_type, ingredients)
+
+    def create(self, model=None, messages=None, stream=False, max_tokens=None, **kwargs):
+        from openai.util import convert_to_openai_object
+        content = self._content(messages)
+        prompt_tokens = sum(len(message['content']) for message in messages)
+        completion_tokens = len(content)
+        # 生成時間與輸出長度成正比，延遲分佈的中位數代表第一個 token 前的等待
+        generation_time = completion_tokens / self.tokens_per_second if self.tokens_per_second > 0 else 0
+        if not stream:
+            self.backend.call(self.backend.delay() + generation_time)
+            return convert_to_openai_object({
+                'choices': [{'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                          'total_tokens': prompt_tokens + completion_tokens},
+            })
+        self.backend.call()
+        # 要求 stream_options.include_usage 時，最後一個 chunk 只有 usage、沒有 choices
+        usage = None
+        if (kwargs.get('stream_options') or {}).get('include_usage'):
+            usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                     'total_tokens': prompt_tokens + completion_tokens}
+        return self._stream(content, generation_time, usage)
+
+    def _stream(self, content, generation_time, usage=None):
+        from openai.util import convert_to_openai_object
+        pieces = [content[i:i + 8] for i in range(0, len(content), 8)]
+        for piece in pieces:
+            time.sleep(generation_time / len(pieces))
+            yield convert_to_openai_object({'choices': [{'delta': {'content': piece}}]})
+        if usage:
+            yield convert_to_openai_object({'choices': [], 'usage': usage})
+
+
+# 記憶體中的 Firestore，只實作本專案用到的介面
+class FakeFirestore:
+    def __init__(self, backend):
+        self.backend = backend
+        self.data = {}
+        self._lock = threading.Lock()
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def write_option(self, exists=None):
+        return {'exists': exists}
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocument:
+    def __init__(self, db, path, doc_id):
+        self.db = db
+        self.path = f"{path}/{doc_id}"
+        self.id = doc_id
+
+    def collection(self, name):
+        return FakeCollection(self.db, f"{self.path}/{name}")
+
+    def get(self):
+        self.db.backend.call()
+        with self.db._lock:
+            return FakeSnapshot(self, self.db.data.get(self.path))
+
+    def set(self, data, merge=False):
+        self.db.backend.call()
+        with self.db._lock:
+            self.db.data[self.path] = {**(self.db.data.get(self.path) or {}), **data} if merge else dict(data)
+
+    def delete(self, option=None):
+        from google.api_core.exceptions import NotFound
+        self.db.backend.call()
+        with self.db._lock:
+            if option and option.get('exists') and self.path not in self.db.data:
+                raise NotFound(self.path)
+            self.db.data.pop(self.path, None)
+
+
+class FakeCollection:
+    def __init__(self, db, path, fields=None, after=None, limit_count=None):
+        self.db = db
+        self.path = path
+        self.fields = fields
+        self.after = after
+        self.limit_count = limit_count
+
+    def _copy(self, **changes):
+        options = {'fields': self.fields, 'after': self.after, 'limit_count': self.limit_count, **changes}
+        return FakeCollection(self.db, self.path, **options)
+
+    def document(self, doc_id=None):
+        return FakeDocument(self.db, self.path, doc_id or uuid.uuid4().hex[:20])
+
+    def select(self, fields):
+        return self._copy(fields=fields)
+
+    def order_by(self, field):
+        return self
+
+    def start_after(self, values):
+        return self._copy(after=next(iter(values.values())))
+
+    def limit(self, count):
+        return self._copy(limit_count=count)
+
+    def stream(self):
+        self.db.backend.call()
+        prefix = self.path + '/'
+        with self.db._lock:
+            items = sorted(
+                (key[len(prefix):], value) for key, value in self.db.data.items()
+                if key.startswith(prefix) and '/' not in key[len(prefix):]
+            )
+        snapshots = []
+        for doc_id, value in items:
+            if self.after is not None and doc_id <= self.after:
+                continue
+            data = {field: value[field] for field in self.fields if field in value} if self.fields else value
+            snapshots.append(FakeSnapshot(self.document(doc_id), data))
+        return snapshots[:self.limit_count] if self.limit_count else snapshots
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, reference, data, merge=False):
+        self.writes.append((reference, data))
+
+    def delete(self, reference):
+        self.writes.append((reference, None))
+
+    def commit(self):
+        self.db.backend.call()
+        with self.db._lock:
+            for reference, data in self.writes:
+                if data is None:
+                    self.db.data.pop(reference.path, None)
+                else:
+                    self.db.data[reference.path] = dict(data)
+
+
+# 產生數張不同的測試圖片；沒有 OpenCV 時改用隨機位元組（前處理會直接使用原圖）
+def generate_images(count, size=1600):
+    images = []
+    try:
+        import cv2
+        import numpy as np
+        for i in range(count):
+            rng = np.random.default_rng(i)
+            image = np.zeros((size * 3 // 4, size, 3), np.uint8)
+            for _ in range(12):
+                center = tuple(int(v) for v in rng.integers(0, size * 3 // 4, 2))
+                color = tuple(int(v) for v in rng.integers(0, 255, 3))
+                cv2.circle(image, center, int(rng.integers(40, 300)), color, -1)
+            images.append(cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes())
+    except ImportError:
+        images = [os.urandom(300 * 1024) for _ in range(count)]
+    return images
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def webhook_event(event_type, user_id, **fields):
+    return {
+        'type': event_type,
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'source': {'type': 'user', 'userId': user_id},
+        'replyToken': uuid.uuid4().hex,
+        'webhookEventId': uuid.uuid4().hex,
+        'deliveryContext': {'isRedelivery': False},
+        **fields,
+    }
+
+def sign(body):
+    return base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.sent_at = {}
+        self.latencies = []
+        self.handler_timings = defaultdict(list)
+        self.rejected = 0
+        self.completed = defaultdict(threading.Event)
+        self._lock = threading.Lock()
+
+    # 以環境變數設定並載入 app，再把外部服務換成假的實作；必須在 import app 之前完成
+    def setup(self):
+        args = self.args
+        os.environ["LINE_CHANNEL_SECRET"] = CHANNEL_SECRET
+        os.environ["LINE_CHANNEL_ACCESS_TOKEN"] = "benchmark-token"
+        os.environ.setdefault("JOB_QUEUE_WORKERS", str(args.workers))
+        os.environ.setdefault("CACHE_BACKEND", "memory")
+        os.environ.setdefault("SESSION_STORE_BACKEND", "memory")
+
+        import openai
+        from google.api_core import exceptions as google_exceptions
+        from client_manager import clients
+        import firebase_service
+        import google_vision_service
+        import chatgpt_service
+
+        self.line_backend = FakeBackend(args.line_latency, args.sigma, args.line_error_rate)
+        self.vision_backend = FakeBackend(args.vision_latency, args.sigma, args.vision_error_rate,
+                                          google_exceptions.ServiceUnavailable)
+        self.openai_backend = FakeBackend(args.openai_latency, args.sigma, args.openai_error_rate,
+                                          openai.error.ServiceUnavailableError)
+        self.firestore_backend = FakeBackend(args.firestore_latency, args.sigma, args.firestore_error_rate)
+
+        self.db = FakeFirestore(self.firestore_backend)
+        self.openai = FakeOpenAI(self.openai_backend, chatgpt_service.RECIPE_SEPARATOR, args.duplicate_rate, args.tokens_per_second)
+        clients.register("firestore", lambda: self.db)
+        clients.register("vision", lambda: FakeVisionClient(self.vision_backend))
+        clients.register("openai", lambda: openai)
+        openai.ChatCompletion.create = self.openai.create
+
+        import app as app_module
+        self.app_module = app_module
+        self.line_bot_api = FakeLineBotApi(self.line_backend, generate_images(args.images))
+        app_module.line_bot_api = self.line_bot_api
+        self._wrap_handlers()
+
+    # 包裝 handle_webhook 與各事件 handler，記錄端到端延遲與各 handler 耗時
+    def _wrap_handlers(self):
+        app_module = self.app_module
+        original_handle_webhook = app_module.handle_webhook
+
+        def handle_webhook(body, signature):
+            try:
+                original_handle_webhook(body, signature)
+            finally:
+                finished = time.perf_counter()
+                for event in json.loads(body)['events']:
+                    event_id = event['webhookEventId']
+                    with self._lock:
+                        sent_at = self.sent_at.pop(event_id, None)
+                        if sent_at is not None:
+                            self.latencies.append(finished - sent_at)
+                    self.completed[event_id].set()
+        app_module.handle_webhook = handle_webhook
+
+        handlers = app_module.handler._handlers
+        for key, func in list(handlers.items()):
+            handlers[key] = self._timed_handler(key, func)
+
+    # WebhookHandler 依參數個數決定呼叫方式，包裝後的函式只能有 event 一個參數
+    def _timed_handler(self, key, func):
+        def timed_handler(event):
+            start = time.perf_counter()
+            try:
+                func(event)
+            finally:
+                with self._lock:
+                    self.handler_timings[key].append(time.perf_counter() - start)
+        return timed_handler
+
+    # 送出一個 webhook 請求，wait 為 True 時等待背景處理完成
+    def post(self, client, events, wait=True):
+        body = json.dumps({'destination': 'benchmark', 'events': events}, ensure_ascii=False)
+        sent_at = time.perf_counter()
+        with self._lock:
+            for event in events:
+                self.sent_at[event['webhookEventId']] = sent_at
+        response = client.post('/callback', data=body.encode('utf-8'),
+                               headers={'X-Line-Signature': sign(body), 'Content-Type': 'application/json'})
+        if response.status_code != 200:
+            with self._lock:
+                self.rejected += 1
+                for event in events:
+                    self.sent_at.pop(event['webhookEventId'], None)
+            return False
+        if wait:
+            for event in events:
+                self.completed[event['webhookEventId']].wait(self.args.event_timeout)
+        return True
+
+    # 一段典型的對話：上傳圖片 → 指定料理 → 其他食譜 → 加入我的最愛
+    def conversation(self, user_index):
+        client = self.app_module.app.test_client()
+        rng = random.Random(user_index)
+        for round_index in range(self.args.rounds):
+            user_id = f"Ubench{user_index:05d}"
+            image_id = f"img-{rng.randrange(self.args.images)}"
+            self.post(client, [webhook_event('message', user_id, message={'type': 'image', 'id': image_id})])
+            text = f"我想做{rng.choice(DISH_TYPES)}料理{rng.choice(COUNT_WORDS)}"
+            self.post(client, [webhook_event('message', user_id, message={'type': 'text', 'id': uuid.uuid4().hex, 'text': text})])
+            flex = self.line_bot_api.last_flex(user_id)
+            if not flex:
+                continue
+            contents = flex['contents']
+            bubble = contents['contents'][0] if contents.get('type') == 'carousel' else contents
+            buttons = bubble['footer']['contents']
+            for button in buttons:
+                self.post(client, [webhook_event('postback', user_id, postback={'data': button['action']['data']})])
+
+    # 重播錄下的 webhook body（每行一個 JSON），以 users 個執行緒平均分配
+    def replay(self, path, user_index):
+        client = self.app_module.app.test_client()
+        with open(path, encoding='utf-8') as f:
+            bodies = [json.loads(line) for line in f if line.strip()]
+        for body in bodies[user_index::self.args.users]:
+            events = body.get('events', [])
+            for event in events:
+                event['webhookEventId'] = uuid.uuid4().hex
+            if events:
+                self.post(client, events)
+
+    def run(self):
+        self.setup()
+        target = (lambda i: self.replay(self.args.events, i)) if self.args.events else self.conversation
+        threads = [threading.Thread(target=target, args=(i,)) for i in range(self.args.users)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        from metrics import metrics
+        stages = {
+            labels['stage']: {'count': count, 'mean_ms': round(total / count * 1000, 1)}
+            for labels, count, total in metrics.summaries("foodlens_stage_duration_seconds") if count
+        }
+        summarize = lambda values: {
+            'count': len(values),
+            'p50_ms': round(percentile(values, 50) * 1000, 1),
+            'p95_ms': round(percentile(values, 95) * 1000, 1),
+            'p99_ms': round(percentile(values, 99) * 1000, 1),
+        }
+        backends = {
+            'line': self.line_backend, 'vision': self.vision_backend,
+            'openai': self.openai_backend, 'firestore': self.firestore_backend,
+        }
+        return {
+            'elapsed_s': round(elapsed, 2),
+            'events': len(self.latencies),
+            'rejected_requests': self.rejected,
+            'throughput_eps': round(len(self.latencies) / elapsed, 2) if elapsed else 0.0,
+            'end_to_end': summarize(self.latencies),
+            'handlers': {key: summarize(values) for key, values in sorted(self.handler_timings.items())},
+            'stages': dict(sorted(stages.items())),
+            'backend_calls': {name: {'calls': b.calls, 'errors': b.errors} for name, b in backends.items()},
+        }
+
+
+def print_report(report):
+    print(f"\n耗時 {report['elapsed_s']} 秒，完成 {report['events']} 個事件，"
+          f"被拒絕 {report['rejected_requests']} 個請求，吞吐量 {report['throughput_eps']} 事件/秒")
+    rows = [('end_to_end', report['end_to_end'])] + list(report['handlers'].items())
+    print(f"\n{'項目':<28}{'次數':>8}{'p50(ms)':>12}{'p95(ms)':>12}{'p99(ms)':>12}")
+    for name, row in rows:
+        print(f"{name:<30}{row['count']:>8}{row['p50_ms']:>12}{row['p95_ms']:>12}{row['p99_ms']:>12}")
+    print(f"\n{'階段':<28}{'次數':>8}{'平均(ms)':>12}")
+    for name, row in report['stages'].items():
+        print(f"{name:<30}{row['count']:>8}{row['mean_ms']:>12}")
+    print(f"\n{'假服務':<28}{'呼叫':>8}{'錯誤':>10}")
+    for name, row in report['backend_calls'].items():
+        print(f"{name:<31}{row['calls']:>8}{row['errors']:>10}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="以假的外部服務對 callback() 進行離線壓力測試")
+    parser.add_argument("--users", type=int, default=10, help="同時進行對話的使用者數")
+    parser.add_argument("--rounds", type=int, default=3, help="每位使用者進行的對話輪數")
+    parser.add_argument("--events", help="改為重播錄下的 webhook body（JSON Lines）")
+    parser.add_argument("--workers", type=int, default=4, help="JOB_QUEUE_WORKERS（未設定環境變數時使用）")
+    parser.add_argument("--images", type=int, default=20, help="產生的不同測試圖片數")
+    parser.add_argument("--sigma", type=float, default=0.5, help="延遲對數常態分佈的 sigma")
+    parser.add_argument("--line-latency", type=float, default=0.05)
+    parser.add_argument("--line-error-rate", type=float, default=0.0)
+    parser.add_argument("--vision-latency", type=float, default=0.4)
+    parser.add_argument("--vision-error-rate", type=float, default=0.0)
+    parser.add_argument("--openai-latency", type=float, default=0.8, help="第一個 token 前的等待（秒）")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="假 OpenAI 的輸出速度（字元/秒）")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="假 OpenAI 回傳重複料理名稱的機率")
+    parser.add_argument("--firestore-latency", type=float, default=0.03)
+    parser.add_argument("--firestore-error-rate", type=float, default=0.0)
+    parser.add_argument("--event-timeout", type=float, default=120, help="等待單一事件處理完成的上限（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="另外將結果寫入 JSON 檔")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    report = Benchmark(args).run()
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
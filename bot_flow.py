@@ -0,0 +1,374 @@
+import os
+import re
+import random
+from linebot.models import TextSendMessage
+from firebase_service import allocate_recipe_ids
+from recipe_index import recipe_index
+from recipe_cache import COUNT_PATTERN, get_cached_recipes, add_cached_recipes
+from session_store import (
+    create_session_store, save_request_context, load_request_context, update_request_context, invalidate_favorites_cache
+)
+from flex_templates import recipe_bubble, bubble_message, carousel_messages, message_batches
+from metrics import metrics, stage
+
+# LINE 事件的處理流程，同步（Flask，app.py）與非同步（ASGI，asgi_app.py）兩種模式共用
+# 流程寫成 coroutine，所有 I/O 都透過 BotIO 進行：
+# 同步模式的 BotIO 直接以阻塞呼叫完成，coroutine 不會真的暫停，由 run_sync 一次執行完畢；
+# 非同步模式的 BotIO 使用非同步客戶端，會阻塞的快取與 session store 呼叫則交給執行緒
+
+# 多道食譜的生成方式：parallel（並行呼叫）、batch（單一 prompt 生成多道）、serial（逐道呼叫）
+RECIPE_GENERATION_MODE = os.getenv("RECIPE_GENERATION_MODE", "parallel")
+# 因重複或失敗而額外重新生成的總次數上限
+RECIPE_MAX_RETRIES = int(os.getenv("RECIPE_MAX_RETRIES", 3))
+# 「其他食譜」從索引的前幾名強相符結果中隨機挑選，避免每次都回傳同一道
+RECIPE_INDEX_CANDIDATES = int(os.getenv("RECIPE_INDEX_CANDIDATES", 5))
+# 尚未寫入 Firestore 的新食譜，以 recipe_id 為 key 暫存在所有 worker 共用的 store
+# 寫入完成前（或寫入失敗時）按下「加入我的最愛」仍能取得食譜內容
+PENDING_RECIPE_TTL = float(os.getenv("PENDING_RECIPE_TTL", 24 * 60 * 60))
+# 背景批次寫入失敗時的重試次數
+RECIPE_WRITE_RETRIES = int(os.getenv("RECIPE_WRITE_RETRIES", 2))
+
+# 儲存處理後的食材資料（供後續使用），由所有 worker 共用並會依 TTL 與容量上限淘汰
+user_ingredients = create_session_store("user_ingredients")
+pending_recipes = create_session_store("pending_recipes", ttl=PENDING_RECIPE_TTL)
+
+
+# 流程需要的 I/O，由 app.SyncBotIO 與 asgi_app.AsyncBotIO 實作
+class BotIO:
+    # 執行會阻塞的函式（快取、session store）
+    async def call(self, func, *args):
+        raise NotImplementedError
+
+    async def send_message(self, event, messages):
+        raise NotImplementedError
+
+    # 串流生成時的回呼，在生成過程中同步呼叫
+    def notify_preparing(self, event, dish_name):
+        raise NotImplementedError
+
+    async def download_image(self, message_id):
+        raise NotImplementedError
+
+    async def preprocess_image(self, image_content):
+        raise NotImplementedError
+
+    async def detect_labels(self, image_content):
+        raise NotImplementedError
+
+    async def translate_ingredients(self, labels):
+        raise NotImplementedError
+
+    async def generate_recipe(self, dish_type, ingredients, exclude_dishes, on_dish_name=None):
+        raise NotImplementedError
+
+    async def generate_recipes_batch(self, dish_type, count, ingredients, exclude_dishes):
+        raise NotImplementedError
+
+    # 並行執行多個 coroutine function，依序回傳結果
+    async def run_concurrently(self, funcs):
+        raise NotImplementedError
+
+    # 在背景執行 coroutine function，不等待結果
+    def run_in_background(self, func):
+        raise NotImplementedError
+
+    async def get_db(self):
+        raise NotImplementedError
+
+    async def get_recipe(self, db, recipe_id):
+        raise NotImplementedError
+
+    async def save_recipes_batch(self, db, user_id, recipes, dish_type):
+        raise NotImplementedError
+
+    async def save_favorite(self, db, user_id, recipe_id, recipe):
+        raise NotImplementedError
+
+
+# 執行同步 BotIO 的流程；BotIO 的方法都不會暫停，因此第一次 send 就會執行完畢
+def run_sync(coroutine):
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coroutine.close()
+    raise RuntimeError("同步模式的流程不應該暫停")
+
+
+# 問使用者料理需求
+def ask_user_for_recipe_info():
+    return "您今天想做甚麼樣的料理？幾道菜？"
+
+# 提取料理類型和菜數
+def parse_user_message(user_message):
+    match = re.search(r"做(.+)", user_message)
+    dish_type = COUNT_PATTERN.sub('', match.group(1)).strip() if match else ""
+    dish_type = dish_type or "料理"
+
+    dish_count = None
+    if re.search(r"\d+", user_message):
+        dish_count = int(re.search(r"\d+", user_message).group())
+    else:
+        dish_count = chinese_to_digit(user_message)
+
+    return dish_type, dish_count if dish_count else 1
+
+# 將中文數字轉換為阿拉伯數字的函數
+def chinese_to_digit(user_message):
+    chinese_digits = {'零': 0, '一': 1, '二': 2, '兩': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+    chinese_num = re.search(r"[零一二兩三四五六七八九]", user_message)
+    if chinese_num:
+        return chinese_digits[chinese_num.group()]
+    return None
+
+# 正規化菜名後比對，去除空白與標點造成的假性不重複
+def normalize_dish_name(dish_name):
+    return re.sub(r'[\s\W_]+', '', dish_name or '').lower()
+
+# 從候選食譜中保留不重複且有效的項目，最多 limit 道
+# 回傳 (料理名稱, 食材, 食譜內容, recipe_id) 的列表，新生成的食譜 recipe_id 為 None
+def dedup_recipes(candidates, existing_dishes, limit):
+    kept = []
+    for dish_name, ingredient_text, recipe_text, *rest in candidates:
+        if len(kept) >= limit:
+            break
+        if not dish_name or not recipe_text:
+            continue
+        key = normalize_dish_name(dish_name)
+        if key in existing_dishes:
+            print(f"生成的食譜重複: {dish_name}")
+            metrics.increment("foodlens_recipe_duplicates_total")
+            continue
+        existing_dishes.add(key)
+        kept.append((dish_name, ingredient_text, recipe_text, rest[0] if rest else None))
+    return kept
+
+# 從本地食譜索引找出與使用者食材強相符、且料理類型相同的已存食譜
+def find_indexed_recipes(ingredients, limit, exclude_dishes=None, dish_type=None):
+    return [
+        (dish_name, ingredient_text, recipe_text, recipe_id)
+        for recipe_id, dish_name, ingredient_text, recipe_text in recipe_index.search(ingredients, limit, exclude_dishes, dish_type)
+    ]
+
+# 為尚未儲存的食譜產生文件 ID，回傳 (所有食譜, 需要寫入的新食譜)
+def assign_recipe_ids(db, recipes):
+    new_ids = iter(allocate_recipe_ids(db, sum(1 for recipe in recipes if recipe[3] is None)))
+    assigned = []
+    new_recipes = []
+    for dish_name, ingredient_text, recipe_text, recipe_id in recipes:
+        if recipe_id is None:
+            recipe_id = next(new_ids)
+            new_recipes.append((recipe_id, dish_name, recipe_text, ingredient_text))
+        assigned.append((dish_name, ingredient_text, recipe_text, recipe_id))
+    return assigned, new_recipes
+
+# 將寫入成功的新食譜加入本地食譜索引
+def index_recipes(new_recipes, dish_type=None):
+    for recipe_id, dish_name, recipe_text, ingredient_text in new_recipes:
+        recipe_index.add(recipe_id, dish_name, ingredient_text, recipe_text, dish_type)
+
+def track_pending_recipes(user_id, new_recipes):
+    for recipe_id, dish_name, recipe_text, ingredient_text in new_recipes:
+        pending_recipes.set(recipe_id, {'user_id': user_id, 'dish': dish_name, 'ingredient': ingredient_text, 'recipe': recipe_text})
+
+# 寫入成功後加入本地食譜索引並移除暫存；最後一次重試仍失敗時保留暫存並累計失敗次數
+def on_recipes_saved(new_recipes, saved, retries_left, dish_type=None):
+    if saved:
+        index_recipes(new_recipes, dish_type)
+        for recipe in new_recipes:
+            pending_recipes.delete(recipe[0])
+    elif retries_left <= 0:
+        metrics.increment("foodlens_recipe_write_failures_total")
+        print(f"食譜批次寫入失敗，{len(new_recipes)} 道食譜只保留在暫存中: {[recipe[0] for recipe in new_recipes]}")
+
+# Firestore 找不到時（尚未寫入或寫入失敗）改從暫存取得
+def find_recipe(recipe, recipe_id):
+    return recipe or (pending_recipes.get(recipe_id) if recipe_id else None)
+
+
+async def save_recipes(io, db, user_id, new_recipes, dish_type):
+    for retries_left in range(RECIPE_WRITE_RETRIES, -1, -1):
+        saved = await io.save_recipes_batch(db, user_id, new_recipes, dish_type)
+        await io.call(on_recipes_saved, new_recipes, saved, retries_left, dish_type)
+        if saved:
+            return
+
+# 在背景批次寫入新食譜，失敗時重試
+async def persist_recipes(io, db, user_id, new_recipes, dish_type=None):
+    if not new_recipes:
+        return
+    await io.call(track_pending_recipes, user_id, new_recipes)
+    io.run_in_background(lambda: save_recipes(io, db, user_id, new_recipes, dish_type))
+
+# 處理圖片訊息，進行 Google Cloud Vision 的物體偵測（Label Detection）
+async def handle_image_message(io, event):
+    # 串流讀取圖片內容，並縮小、重新編碼後再送給 Vision
+    with stage("download"):
+        image_content = await io.download_image(event.message.id)
+    with stage("preprocess"):
+        image_content = await io.preprocess_image(image_content)
+
+    detected_labels = await io.detect_labels(image_content)
+
+    if detected_labels:
+        print(f"辨識到的食材: {detected_labels}")  # 在 log 中顯示食材
+        processed_text = await io.translate_ingredients(detected_labels)
+        user_id = event.source.user_id
+        if processed_text:
+            await io.call(user_ingredients.set, user_id, processed_text)
+            await io.send_message(event, TextSendMessage(text=ask_user_for_recipe_info()))
+        else:
+            await io.send_message(event, TextSendMessage(text="未能識別出任何食材，請嘗試上傳另一張清晰的圖片。"))
+    else:
+        await io.send_message(event, TextSendMessage(text="無法辨識出任何物體，請確保圖片中的食材明顯可見。"))
+
+# on_dish_name 只用於單道料理，避免多道料理時推播過多訊息
+async def generate_multiple_recipes(io, dish_count, dish_type, ingredients, on_dish_name=None):
+    recipes = []
+    existing_dishes = set()  # 用於追踪生成的菜名，避免重複
+    retries_left = RECIPE_MAX_RETRIES
+    first_round = True
+
+    # 依序從生成快取、本地食譜索引取用食譜，不足的部分才呼叫 GPT-4
+    cached = await io.call(get_cached_recipes, dish_type, ingredients, dish_count)
+    recipes.extend(dedup_recipes(cached, existing_dishes, dish_count))
+    if len(recipes) < dish_count:
+        missing = dish_count - len(recipes)
+        indexed = find_indexed_recipes(ingredients, missing, [recipe[0] for recipe in recipes], dish_type)
+        recipes.extend(dedup_recipes(indexed, existing_dishes, missing))
+    if len(recipes) >= dish_count:
+        return recipes
+
+    if RECIPE_GENERATION_MODE == "batch":
+        missing = dish_count - len(recipes)
+        candidates = await io.generate_recipes_batch(dish_type, missing, ingredients, [recipe[0] for recipe in recipes])
+        recipes.extend(dedup_recipes(candidates, existing_dishes, missing))
+        first_round = False
+
+    while len(recipes) < dish_count:
+        calls = dish_count - len(recipes)
+        # 第一輪之後的呼叫都屬於重新生成，總數受 RECIPE_MAX_RETRIES 限制
+        if not first_round:
+            if retries_left <= 0:
+                print(f"重新生成次數已達上限，僅回傳 {len(recipes)} 道食譜")
+                break
+            calls = min(calls, retries_left)
+            retries_left -= calls
+            metrics.increment("foodlens_recipe_regenerations_total", calls)
+        first_round = False
+
+        exclude_dishes = [recipe[0] for recipe in recipes]
+        callback = on_dish_name if dish_count == 1 else None
+        generate = lambda: io.generate_recipe(dish_type, ingredients, exclude_dishes, on_dish_name=callback)
+        if RECIPE_GENERATION_MODE == "serial":
+            candidates = [await generate() for _ in range(calls)]
+        else:
+            candidates = await io.run_concurrently([generate] * calls)
+        recipes.extend(dedup_recipes(candidates, existing_dishes, calls))
+    return recipes
+
+# 依使用者指定的料理類型與數量回覆多道食譜
+async def handle_message(io, event):
+    user_id = event.source.user_id
+    dish_type, dish_count = parse_user_message(event.message.text)
+    ingredients = await io.call(user_ingredients.get, user_id)
+    if not ingredients:
+        await io.send_message(event, TextSendMessage(text="請先上傳圖片來辨識食材。"))
+        return
+
+    recipes = await generate_multiple_recipes(
+        io, dish_count, dish_type, ingredients, on_dish_name=lambda name: io.notify_preparing(event, name)
+    )
+    if not recipes:
+        await io.send_message(event, TextSendMessage(text="生成食譜失敗，請稍後再試。"))
+        return
+    # 回覆多頁式的食譜 Flex Message；新食譜的文件 ID 先在本地產生，送出訊息後再以單一批次寫入 Firestore
+    db = await io.get_db()
+    recipes, new_recipes = assign_recipe_ids(db, recipes)
+    await io.call(add_cached_recipes, dish_type, ingredients, recipes)
+    context_token = await io.call(save_request_context, {
+        'ingredients': ingredients,
+        'dish_type': dish_type,
+        'shown_dishes': [recipe[0] for recipe in recipes]
+    })
+    flex_bubbles = [
+        recipe_bubble(recipe_text, dish_name, ingredient_text, i + 1, recipe_id, context_token)
+        for i, (dish_name, ingredient_text, recipe_text, recipe_id) in enumerate(recipes)
+    ]
+    # 超過 12 張或 50KB 的 carousel 會拆成多則訊息，每次推播最多 5 則
+    for messages in message_batches(carousel_messages("您的多道食譜", flex_bubbles)):
+        await io.send_message(event, messages)
+    await persist_recipes(io, db, user_id, new_recipes, dish_type)
+
+# 「其他食譜」：依 context_token 取回請求內容，回覆一道尚未顯示過的料理
+async def handle_new_recipe(io, event, params):
+    user_id = event.source.user_id
+    await io.send_message(event, TextSendMessage(text="沒問題，請稍後~"))
+    try:
+        context_token = params.get('ctx')
+        context = await io.call(load_request_context, context_token) if context_token else None
+        if context is None:
+            # token 過期或舊版按鈕：改用 postback 內的食材或使用者目前的食材
+            ingredients_str = params.get('ingredients', '')
+            ingredients = ingredients_str.split(',') if ingredients_str else await io.call(user_ingredients.get, user_id)
+            if not ingredients:
+                await io.send_message(event, TextSendMessage(text="請先上傳圖片來辨識食材。"))
+                return
+            context = {'ingredients': ingredients, 'dish_type': "新的食譜", 'shown_dishes': []}
+            context_token = await io.call(save_request_context, context)
+        ingredients = context['ingredients']
+        dish_type = context['dish_type']
+        shown_dishes = context['shown_dishes']
+
+        # 依序從生成快取輪流取用、從本地食譜索引的強相符結果中隨機挑一道，都沒有才呼叫 GPT-4
+        # 已經顯示過的料理都會排除
+        cached = (await io.call(get_cached_recipes, dish_type, ingredients, 1, shown_dishes)
+                  or find_indexed_recipes(ingredients, RECIPE_INDEX_CANDIDATES, shown_dishes, dish_type))
+        if cached:
+            dish_name, ingredient_text, recipe_text, recipe_id = random.choice(cached)
+        else:
+            # 料理名稱一出現就先通知使用者
+            dish_name, ingredient_text, recipe_text = await io.generate_recipe(
+                dish_type, ingredients, shown_dishes, on_dish_name=lambda name: io.notify_preparing(event, name)
+            )
+            recipe_id = None
+
+        if dish_name and recipe_text:
+            db = await io.get_db()
+            assigned, new_recipes = assign_recipe_ids(db, [(dish_name, ingredient_text, recipe_text, recipe_id)])
+            recipe_id = assigned[0][3]
+            await io.call(add_cached_recipes, dish_type, ingredients, assigned)
+            context['shown_dishes'] = shown_dishes + [dish_name]
+            await io.call(update_request_context, context_token, context)
+            await io.send_message(
+                event,
+                bubble_message("您的新食譜", recipe_bubble(recipe_text, dish_name, ingredient_text, 1, recipe_id, context_token))
+            )
+            await persist_recipes(io, db, user_id, new_recipes, dish_type)
+        else:
+            await io.send_message(event, TextSendMessage(text="生成食譜失敗，請稍後再試。"))
+    except Exception as e:
+        print(f"生成食譜時發生錯誤: {e}")
+        await io.send_message(event, TextSendMessage(text="生成食譜時出現問題，請稍後再試。"))
+
+# 將食譜加入我的最愛
+async def handle_save_favorite(io, event, params):
+    user_id = event.source.user_id
+    recipe_id = params.get('recipe_id')
+    db = await io.get_db()
+    recipe = await io.get_recipe(db, recipe_id)
+    recipe = await io.call(find_recipe, recipe, recipe_id)
+    if not recipe:
+        await io.send_message(event, TextSendMessage(text="找不到該食譜，無法加入我的最愛"))
+    elif await io.save_favorite(db, user_id, recipe_id, recipe):
+        await io.call(invalidate_favorites_cache, user_id)
+        await io.send_message(event, TextSendMessage(text="已成功將食譜加入我的最愛!"))
+    else:
+        await io.send_message(event, TextSendMessage(text="抱歉，儲存過程中發生錯誤。"))
+
+async def handle_postback(io, event, params):
+    action = params.get('action')
+    if action == 'new_recipe':
+        await handle_new_recipe(io, event, params)
+    elif action == 'save_favorite':
+        await handle_save_favorite(io, event, params)
@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# 快取設定：後端可選 memory（單一程序）或 sqlite（同一台機器的所有 worker 共用）
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", "/tmp/foodlens-cache.sqlite3")
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", 1024))
+CACHE_TTL = float(os.getenv("CACHE_TTL", 24 * 60 * 60))
+# SQLite 快取每寫入幾次才檢查一次容量並清除過期項目，避免每次寫入都計算筆數
+SQLITE_EVICT_INTERVAL = int(os.getenv("SQLITE_EVICT_INTERVAL", 100))
+# 讀取命中時，存取時間超過幾秒未更新才寫回，避免每次讀取都佔用 SQLite 的寫入鎖
+SQLITE_TOUCH_INTERVAL = float(os.getenv("SQLITE_TOUCH_INTERVAL", 60))
+
+
+# 記憶體快取：OrderedDict 實作 LRU，並支援 TTL 過期
+class MemoryCache:
+    def __init__(self, name, max_size=CACHE_MAX_SIZE, ttl=CACHE_TTL):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'backend': 'memory',
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+# SQLite 快取：以檔案共享給同一台機器上的多個程序，值以 JSON 儲存
+# 容量檢查每 SQLITE_EVICT_INTERVAL 次寫入才做一次，期間筆數可能暫時超過 max_size
+class SqliteCache:
+    def __init__(self, name, path=CACHE_SQLITE_PATH, max_size=CACHE_MAX_SIZE, ttl=CACHE_TTL):
+        self.name = name
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._writes = 0
+        # 容量較小的快取檢查得較頻繁，超出的筆數最多約為容量的一成
+        self.evict_interval = max(1, min(SQLITE_EVICT_INTERVAL, max_size // 10))
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "name TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "expires_at REAL, accessed_at REAL NOT NULL, PRIMARY KEY (name, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (name, accessed_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (name, expires_at)")
+
+    # 每個執行緒（以及 fork 後的每個程序）各自持有連線
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, attr):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def get(self, key):
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value, expires_at, accessed_at FROM cache WHERE name = ? AND key = ?", (self.name, key)
+        ).fetchone()
+        if row is None:
+            self._count('misses')
+            return None
+        value, expires_at, accessed_at = row
+        if expires_at is not None and expires_at <= now:
+            conn.execute("DELETE FROM cache WHERE name = ? AND key = ?", (self.name, key))
+            self._count('misses')
+            return None
+        if now - accessed_at > SQLITE_TOUCH_INTERVAL:
+            conn.execute("UPDATE cache SET accessed_at = ? WHERE name = ? AND key = ?", (now, self.name, key))
+        self._count('hits')
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        conn = self._connect()
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = now + ttl if ttl else None
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (name, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (self.name, key, json.dumps(value, ensure_ascii=False), expires_at, now)
+        )
+        with self._lock:
+            self._writes += 1
+            check = self._writes % self.evict_interval == 0
+        if check:
+            self._evict(conn, now)
+
+    # 清除過期項目，超過容量時再刪除最久未使用的項目
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM cache WHERE name = ? AND expires_at <= ?", (self.name, now))
+        excess = len(self) - self.max_size
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM cache WHERE name = ? AND key IN "
+                "(SELECT key FROM cache WHERE name = ? ORDER BY accessed_at LIMIT ?)",
+                (self.name, self.name, excess)
+            )
+            with self._lock:
+                self.evictions += excess
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM cache WHERE name = ? AND key = ?", (self.name, key))
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM cache WHERE name = ?", (self.name,)).fetchone()[0]
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'backend': 'sqlite',
+            'size': len(self),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+# 所有建立過的快取，方便統一輸出統計資訊
+caches = {}
+
+def create_cache(name, backend=None, max_size=CACHE_MAX_SIZE, ttl=CACHE_TTL):
+    backend = backend or CACHE_BACKEND
+    if backend == "sqlite":
+        cache = SqliteCache(name, max_size=max_size, ttl=ttl)
+    else:
+        cache = MemoryCache(name, max_size=max_size, ttl=ttl)
+    caches[name] = cache
+    return cache
+
+def get_cache_stats():
+    return [cache.stats() for cache in caches.values()]
@@ -1,73 +1,408 @@
-import openai
 import re
+import math
+import requests
 import os
+import asyncio
+import hashlib
 from dotenv import load_dotenv
+from cache_service import create_cache
+from client_manager import clients
+from outbound import OutboundPolicy
+from metrics import timed, record_token_usage
+from ingredient_dictionary import split_labels
 
-# 初始化 OpenAI API 金鑰
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY") # 使用環境變數 os.getenv("OPENAI_API_KEY")
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", 10))
 
-# 翻譯並過濾非食材詞彙
+# 第一次使用時才 import openai 並設定 API 金鑰，縮短程序啟動時間
+# 同時建立共用的 HTTP session，讓 OpenAI 呼叫重複使用 keep-alive 連線而不是每次重新握手
+def initialize_openai():
+    import openai
+    openai.api_key = os.getenv("OPENAI_API_KEY") # 使用環境變數 os.getenv("OPENAI_API_KEY")
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=OPENAI_POOL_SIZE)
+    session.mount("https://", adapter)
+    openai.requestssession = session
+    return openai
+
+clients.register("openai", initialize_openai)
+
+def openai_retryable_errors():
+    import openai
+    return (
+        openai.error.RateLimitError,
+        openai.error.APIError,
+        openai.error.Timeout,
+        openai.error.ServiceUnavailableError,
+        openai.error.APIConnectionError,
+        openai.error.TryAgain,
+    )
+
+# OpenAI 呼叫的限流、重試與斷路器，設定值見 outbound.OutboundPolicy（OPENAI_ 前綴的環境變數）
+openai_policy = OutboundPolicy("openai", retryable=openai_retryable_errors)
+
+# 依任務選擇模型：翻譯與過濾食材使用較便宜的小模型，只有生成食譜使用 GPT-4
+OPENAI_TRANSLATION_MODEL = os.getenv("OPENAI_TRANSLATION_MODEL", "gpt-4o-mini")
+OPENAI_RECIPE_MODEL = os.getenv("OPENAI_RECIPE_MODEL", "gpt-4")
+# 每次請求的輸出 token 上限；批次生成多道食譜時也不超過 RECIPE_BATCH_MAX_TOKENS
+TRANSLATION_MAX_TOKENS = int(os.getenv("TRANSLATION_MAX_TOKENS", 120))
+RECIPE_MAX_TOKENS = int(os.getenv("RECIPE_MAX_TOKENS", 800))
+RECIPE_BATCH_MAX_TOKENS = int(os.getenv("RECIPE_BATCH_MAX_TOKENS", 2400))
+# prompt 的輸入上限：送去翻譯的標籤數、食材文字長度，以及要求排除的已出現料理數
+TRANSLATION_MAX_LABELS = int(os.getenv("TRANSLATION_MAX_LABELS", 15))
+PROMPT_MAX_INGREDIENT_CHARS = int(os.getenv("PROMPT_MAX_INGREDIENT_CHARS", 300))
+PROMPT_MAX_EXCLUDE_DISHES = int(os.getenv("PROMPT_MAX_EXCLUDE_DISHES", 20))
+
+# 串流生成時要求 API 在最後一個 chunk 附上 usage（stream_options）；不支援此參數的端點可設為 0，改以文字長度估計
+OPENAI_STREAM_USAGE = os.getenv("OPENAI_STREAM_USAGE", "1") == "1"
+
+# 以排序後的標籤集合為 key 快取 LLM 對字典外標籤的翻譯結果
+translation_cache = create_cache("label_translation", ttl=float(os.getenv("TRANSLATION_CACHE_TTL", 7 * 24 * 60 * 60)))
+
+def labels_cache_key(detected_labels):
+    normalized = sorted({label.strip().lower() for label in detected_labels})
+    return hashlib.sha256('\n'.join(normalized).encode('utf-8')).hexdigest()
+
+# 翻譯與過濾食材的請求參數，同步與非同步版本共用；Vision 的標籤依分數排序，只保留前 TRANSLATION_MAX_LABELS 個
+def translation_request(labels):
+    labels = labels[:TRANSLATION_MAX_LABELS]
+    prompt = (
+        f"以下是從圖片中辨識出的物體列表：\n{', '.join(labels)}\n"
+        f"請將其翻譯成繁體中文，並只保留與食材相關的詞彙，去除非食材的詞彙。"
+        f"只輸出以「、」分隔的食材名稱，沒有任何食材時輸出「無」。"
+    )
+    return dict(
+        model=OPENAI_TRANSLATION_MODEL,
+        messages=[
+            {"role": "system", "content": "你是一個專業的翻譯助手，並且能過濾出與食材相關的內容。"},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=TRANSLATION_MAX_TOKENS,
+        temperature=0,
+        request_timeout=openai_policy.timeout
+    )
+
+# 合併本地字典的翻譯與 LLM 的翻譯結果，沒有任何食材時回傳 None
+def merge_translations(known, translated_text):
+    ingredients = list(known)
+    for item in re.split(r"[、，,；;\n]+", translated_text or ''):
+        item = item.strip(" 。.-*•")
+        if item and item != "無" and item not in ingredients:
+            ingredients.append(item)
+    return '、'.join(ingredients) or None
+
+# 翻譯並過濾非食材詞彙：字典中有的標籤在本地處理，只有字典外的標籤才呼叫 LLM
+@timed("translate")
 def translate_and_filter_ingredients(detected_labels):
-    prompt = f"以下是從圖片中辨識出的物體列表：\n{', '.join(detected_labels)}\n請將其翻譯成繁體中文，並只保留與食材相關的詞彙，去除非食材的詞彙。"
+    known, unknown = split_labels(detected_labels)
+    if not unknown:
+        return merge_translations(known, None)
+    cache_key = labels_cache_key(unknown)
+    cached_text = translation_cache.get(cache_key)
+    if cached_text is not None:
+        return merge_translations(known, cached_text)
+
+    def translate():
+        openai = clients.get("openai")
+        response = openai.ChatCompletion.create(**translation_request(unknown))
+        record_token_usage("translate", response.get('usage'))
+        processed_text = response.choices[0].message['content'].strip()
+        translation_cache.set(cache_key, processed_text)
+        return processed_text
+
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "你是一個專業的翻譯助手，並且能過濾出與食材相關的內容。"},
-                {"role": "user", "content": prompt}
-            ]
-        )
+        # 同一組標籤同時有多個請求時只呼叫一次 API
+        return merge_translations(known, openai_policy.call(translate, key=cache_key))
+    except Exception as e:
+        print(f"翻譯和過濾過程中發生錯誤: {str(e)}")
+        # 翻譯失敗時仍可使用字典翻譯出的食材
+        return merge_translations(known, None)
+
+# translate_and_filter_ingredients 的非同步版本，供 ASGI 模式使用
+@timed("translate")
+async def translate_and_filter_ingredients_async(detected_labels):
+    known, unknown = split_labels(detected_labels)
+    if not unknown:
+        return merge_translations(known, None)
+    cache_key = labels_cache_key(unknown)
+    # 快取可能是 sqlite，查詢與寫入交給執行緒，不阻塞事件迴圈
+    cached_text = await asyncio.to_thread(translation_cache.get, cache_key)
+    if cached_text is not None:
+        return merge_translations(known, cached_text)
+
+    async def translate():
+        openai = clients.get("openai")
+        response = await openai.ChatCompletion.acreate(**translation_request(unknown))
+        record_token_usage("translate", response.get('usage'))
         processed_text = response.choices[0].message['content'].strip()
+        await asyncio.to_thread(translation_cache.set, cache_key, processed_text)
         return processed_text
+
+    try:
+        return merge_translations(known, await openai_policy.acall(translate, key=cache_key))
     except Exception as e:
         print(f"翻譯和過濾過程中發生錯誤: {str(e)}")
-        return None
+        return merge_translations(known, None)
 
-# 生成食譜
-def generate_recipe_response(dish_type, dish_count, ingredients):
-    # 動態生成 prompt
-    prompt = (
-        f"用戶希望做 {dish_type} 料理，共 {dish_count} 道菜，並指定使用以下食材：{ingredients}。\n"
-        f"請根據需求生成一個詳細的食譜，並按照以下格式輸出：\n\n"
+# 多道食譜在同一段回應中的分隔線
+RECIPE_SEPARATOR = "====="
+
+# 組合生成食譜的 prompt；batch 為 True 時要求一次輸出 dish_count 道以分隔線隔開的料理
+# 食材過長時截斷，排除清單只保留最近的 PROMPT_MAX_EXCLUDE_DISHES 道，避免 prompt 隨著「其他食譜」次數無限增長
+def build_recipe_prompt(dish_type, dish_count, ingredients, exclude_dishes=None, batch=False):
+    if isinstance(ingredients, (list, tuple)):
+        ingredients = '、'.join(ingredients)
+    ingredients = (ingredients or '')[:PROMPT_MAX_INGREDIENT_CHARS]
+    exclude_dishes = list(exclude_dishes or [])[-PROMPT_MAX_EXCLUDE_DISHES:]
+    prompt = f"用戶希望做 {dish_type} 料理，共 {dish_count} 道菜，並指定使用以下食材：{ingredients}。\n"
+    if batch:
+        prompt += f"請生成 {dish_count} 道彼此不同的料理，每道料理按照以下格式輸出，料理之間以一行 {RECIPE_SEPARATOR} 分隔：\n\n"
+    else:
+        prompt += f"請根據需求生成一個詳細的食譜，並按照以下格式輸出：\n\n"
+    prompt += (
         f"料理名稱: [料理名稱，請與主題相關並避免重複]\n"
         f"食材: [食材列表，單行呈現]\n"
         f"食譜內容: [分步驟列點，詳細描述每個步驟]\n"
         f"注意：生成的料理應符合主題 {dish_type}，並根據指定的食材產出食譜。\n"
         f"請確保生成的食譜是從 https://icook.tw/ 中的料理。\n"
     )
+    if exclude_dishes:
+        prompt += f"請不要生成以下已出現過的料理：{'、'.join(exclude_dishes)}。\n"
+    return prompt
 
-    try:
+# 生成食譜的請求參數，同步與非同步版本共用
+def recipe_request(prompt, max_tokens, stream=False):
+    return dict(
+        model=OPENAI_RECIPE_MODEL,
+        messages=[
+            {"role": "system", "content": "你是一位專業的廚師，專注於為用戶創建食譜。"},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=max_tokens,
+        stream=stream,
+        request_timeout=openai_policy.timeout,
+        **({'stream_options': {'include_usage': True}} if stream and OPENAI_STREAM_USAGE else {})
+    )
+
+# 中日韓文字與全形標點，估計 token 數時約每字 1 個 token
+CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+# 沒有 tokenizer 時的粗略估計：中日韓文字每字 1 個 token，其餘每 4 個字元 1 個 token
+def estimate_tokens(text):
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+# 每則訊息另外加上角色與格式的固定開銷
+def estimate_usage(messages, completion_text):
+    return {
+        'prompt_tokens': sum(estimate_tokens(message['content']) + 4 for message in messages),
+        'completion_tokens': estimate_tokens(completion_text),
+    }
+
+# 串流 chunk 的文字；附帶 usage 的最後一個 chunk 沒有 choices
+def chunk_content(chunk):
+    return chunk.choices[0].delta.get('content') if chunk.choices else None
+
+# 串流結束後記錄 token 用量：有 usage chunk 時使用 API 的數字，否則依 prompt 與輸出文字估計
+def record_stream_usage(task, request, usage, completion_text):
+    if usage:
+        record_token_usage(task, usage)
+    else:
+        record_token_usage(task, estimate_usage(request['messages'], completion_text), estimated=True)
+
+# 建立解析器的工廠；串流中途失敗重試時會重新建立解析器，已經回呼過的欄位不再重複通知
+def retry_safe_parser(on_dish_name=None, on_ingredients=None):
+    notified = set()
+
+    def notify_once(field, callback):
+        if callback is None:
+            return None
+        def notify(value):
+            if field not in notified:
+                notified.add(field)
+                callback(value)
+        return notify
+
+    return lambda: RecipeStreamParser(notify_once('dish_name', on_dish_name), notify_once('ingredient_text', on_ingredients))
+
+# 生成食譜；提供 on_dish_name / on_ingredients 時改用串流模式，料理名稱與食材一解析出來就回呼
+@timed("generate_recipe")
+def generate_recipe_response(dish_type, dish_count, ingredients, exclude_dishes=None,
+                             on_dish_name=None, on_ingredients=None):
+    # 動態生成 prompt
+    prompt = build_recipe_prompt(dish_type, dish_count, ingredients, exclude_dishes)
+    stream = on_dish_name is not None or on_ingredients is not None
+    create_parser = retry_safe_parser(on_dish_name, on_ingredients)
+
+    def generate():
         # 調用 OpenAI API
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "你是一位專業的廚師，專注於為用戶創建食譜。"},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=800
-        )
-        recipe = response.choices[0].message['content'].strip()
-
-        # 預設值防止解析錯誤
-        dish_name = "未命名料理"
-        ingredient_text = "未提供食材"
-        recipe_text = "未提供食譜內容"
-
-        # 正則解析返回的食譜內容
-        dish_name_match = re.search(r"(?:料理名稱|名稱)[:：]\s*(.+)", recipe)
-        ingredient_text_match = re.search(r"(?:食材|材料)[:：]\s*(.+)", recipe)
-        recipe_text_match = re.search(r"(?:食譜內容|步驟)[:：]\s*((.|\n)+)", recipe)
-
-        # 賦值解析出的內容
-        if dish_name_match:
-            dish_name = dish_name_match.group(1).strip()
-        if ingredient_text_match:
-            ingredient_text = ingredient_text_match.group(1).strip()
-        if recipe_text_match:
-            recipe_text = recipe_text_match.group(1).strip()
-
-        return dish_name, ingredient_text, recipe_text
+        openai = clients.get("openai")
+        request = recipe_request(prompt, RECIPE_MAX_TOKENS, stream)
+        response = openai.ChatCompletion.create(**request)
+        parser = create_parser()
+        if stream:
+            usage, parts = None, []
+            for chunk in response:
+                usage = getattr(chunk, 'usage', None) or usage
+                content = chunk_content(chunk)
+                if content:
+                    parts.append(content)
+                    parser.feed(content)
+            record_stream_usage("generate_recipe", request, usage, ''.join(parts))
+        else:
+            record_token_usage("generate_recipe", response.get('usage'))
+            parser.feed(response.choices[0].message['content'].strip())
+        return parser.close()
+
+    try:
+        # 平行模式會刻意送出相同的 prompt 以取得不同食譜，因此不合併請求
+        return openai_policy.call(generate)
+    except Exception as e:
+        print(f"生成食譜過程中發生錯誤: {str(e)}")
+        return None, None, None
+
+# generate_recipe_response 的非同步版本；回呼函式仍是同步呼叫，需要 I/O 時應自行排程 task
+@timed("generate_recipe")
+async def generate_recipe_response_async(dish_type, dish_count, ingredients, exclude_dishes=None,
+                                         on_dish_name=None, on_ingredients=None):
+    prompt = build_recipe_prompt(dish_type, dish_count, ingredients, exclude_dishes)
+    stream = on_dish_name is not None or on_ingredients is not None
+    create_parser = retry_safe_parser(on_dish_name, on_ingredients)
+
+    async def generate():
+        openai = clients.get("openai")
+        request = recipe_request(prompt, RECIPE_MAX_TOKENS, stream)
+        response = await openai.ChatCompletion.acreate(**request)
+        parser = create_parser()
+        if stream:
+            usage, parts = None, []
+            async for chunk in response:
+                usage = getattr(chunk, 'usage', None) or usage
+                content = chunk_content(chunk)
+                if content:
+                    parts.append(content)
+                    parser.feed(content)
+            record_stream_usage("generate_recipe", request, usage, ''.join(parts))
+        else:
+            record_token_usage("generate_recipe", response.get('usage'))
+            parser.feed(response.choices[0].message['content'].strip())
+        return parser.close()
+
+    try:
+        return await openai_policy.acall(generate)
     except Exception as e:
         print(f"生成食譜過程中發生錯誤: {str(e)}")
         return None, None, None
+
+# 將批次回應依分隔線拆成多道食譜
+def parse_recipe_batch(content):
+    blocks = [block.strip() for block in content.split(RECIPE_SEPARATOR) if block.strip()]
+    return [parse_recipe_text(block) for block in blocks]
+
+# 以單一 prompt 一次生成多道不重複的食譜，回傳 (料理名稱, 食材, 食譜內容) 的列表
+@timed("generate_recipes_batch")
+def generate_recipes_batch(dish_type, dish_count, ingredients, exclude_dishes=None):
+    prompt = build_recipe_prompt(dish_type, dish_count, ingredients, exclude_dishes, batch=True)
+    max_tokens = min(RECIPE_MAX_TOKENS * dish_count, RECIPE_BATCH_MAX_TOKENS)
+
+    def generate():
+        openai = clients.get("openai")
+        response = openai.ChatCompletion.create(**recipe_request(prompt, max_tokens))
+        record_token_usage("generate_recipes_batch", response.get('usage'))
+        return response.choices[0].message['content'].strip()
+
+    try:
+        return parse_recipe_batch(openai_policy.call(generate))
+    except Exception as e:
+        print(f"批次生成食譜過程中發生錯誤: {str(e)}")
+        return []
+
+@timed("generate_recipes_batch")
+async def generate_recipes_batch_async(dish_type, dish_count, ingredients, exclude_dishes=None):
+    prompt = build_recipe_prompt(dish_type, dish_count, ingredients, exclude_dishes, batch=True)
+    max_tokens = min(RECIPE_MAX_TOKENS * dish_count, RECIPE_BATCH_MAX_TOKENS)
+
+    async def generate():
+        openai = clients.get("openai")
+        response = await openai.ChatCompletion.acreate(**recipe_request(prompt, max_tokens))
+        record_token_usage("generate_recipes_batch", response.get('usage'))
+        return response.choices[0].message['content'].strip()
+
+    try:
+        return parse_recipe_batch(await openai_policy.acall(generate))
+    except Exception as e:
+        print(f"批次生成食譜過程中發生錯誤: {str(e)}")
+        return []
+
+# 食譜各欄位的標記
+DISH_NAME_PATTERN = re.compile(r"(?:料理名稱|名稱)[:：]\s*(.*)")
+INGREDIENT_PATTERN = re.compile(r"(?:食材|材料)[:：]\s*(.*)")
+RECIPE_PATTERN = re.compile(r"(?:食譜內容|步驟)[:：]\s*(.*)")
+
+# 逐行解析 GPT 回傳的食譜文字，可一邊接收串流一邊解析
+# 料理名稱與食材在該行完整收到時立即觸發回呼，食譜內容則在 close() 時整理回傳
+class RecipeStreamParser:
+    def __init__(self, on_dish_name=None, on_ingredients=None):
+        self.on_dish_name = on_dish_name
+        self.on_ingredients = on_ingredients
+        self.dish_name = None
+        self.ingredient_text = None
+        self._pending = ''
+        self._recipe_lines = None
+        # 標記後面沒有內容時（例如「料理名稱：」後直接換行），改取下一個非空白行
+        self._awaiting = None
+
+    def feed(self, chunk):
+        self._pending += chunk
+        *lines, self._pending = self._pending.split('\n')
+        for line in lines:
+            self._handle_line(line)
+
+    def _set_field(self, field, value):
+        value = value.strip()
+        setattr(self, field, value)
+        callback = self.on_dish_name if field == 'dish_name' else self.on_ingredients
+        if callback:
+            try:
+                callback(value)
+            except Exception as e:
+                print(f"食譜串流回呼發生錯誤: {e}")
+
+    def _handle_line(self, line):
+        if self._awaiting and line.strip():
+            field, self._awaiting = self._awaiting, None
+            if getattr(self, field) is None:
+                self._set_field(field, line)
+
+        for field, pattern in (('dish_name', DISH_NAME_PATTERN), ('ingredient_text', INGREDIENT_PATTERN)):
+            if getattr(self, field) is None:
+                match = pattern.search(line)
+                if match and match.group(1).strip():
+                    self._set_field(field, match.group(1))
+                elif match:
+                    self._awaiting = field
+
+        if self._recipe_lines is not None:
+            self._recipe_lines.append(line)
+        else:
+            match = RECIPE_PATTERN.search(line)
+            if match:
+                self._recipe_lines = [match.group(1)]
+
+    # 處理最後一行並回傳 (料理名稱, 食材, 食譜內容)，缺少的欄位以預設值補上
+    def close(self):
+        if self._pending:
+            self._handle_line(self._pending)
+            self._pending = ''
+        recipe_text = '\n'.join(self._recipe_lines).strip() if self._recipe_lines is not None else ''
+        return (
+            self.dish_name or "未命名料理",
+            self.ingredient_text or "未提供食材",
+            recipe_text or "未提供食譜內容",
+        )
+
+# 解析完整的食譜文字，回傳 (料理名稱, 食材, 食譜內容)
+def parse_recipe_text(recipe):
+    parser = RecipeStreamParser()
+    parser.feed(recipe)
+    return parser.close()
@@ -0,0 +1,122 @@
+import os
+import time
+import threading
+
+
+# 全程序共用的外部服務客戶端（Vision、OpenAI、Firestore）
+# 第一次使用時才建立，之後重複使用同一個連線；fork 後的子程序會自動重建，避免共用父程序的 gRPC channel
+# 每個客戶端各自一把鎖，建立較慢的客戶端（例如 Vision）時不會擋住其他客戶端的取用
+class ClientManager:
+    def __init__(self):
+        self._factories = {}
+        self._clients = {}
+        self._locks = {}
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+
+    # 註冊客戶端的建立函式
+    def register(self, name, factory):
+        self._factories[name] = factory
+
+    # fork 時可能有其他執行緒正持有鎖，子程序連同鎖一起重建
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._clients = {}
+                    self._locks = {}
+                    self._pid = os.getpid()
+
+    def _name_lock(self, name):
+        with self._lock:
+            return self._locks.setdefault(name, threading.RLock())
+
+    def get(self, name):
+        self._check_fork()
+        client = self._clients.get(name)
+        if client is not None:
+            return client
+        with self._name_lock(name):
+            client = self._clients.get(name)
+            if client is None:
+                client = self._factories[name]()
+                if client is not None:
+                    self._clients[name] = client
+            return client
+
+    def reset(self, name=None):
+        with self._lock:
+            if name is None:
+                self._clients = {}
+            else:
+                self._clients.pop(name, None)
+
+    # 預先建立所有已註冊的客戶端，讓第一個請求不必負擔初始化成本
+    def warm_up(self, names=None):
+        for name in names or list(self._factories):
+            try:
+                self.get(name)
+            except Exception as e:
+                print(f"初始化 {name} 客戶端失敗: {e}")
+
+    def is_ready(self, name):
+        return self._pid == os.getpid() and self._clients.get(name) is not None
+
+
+# 在背景執行緒中依序執行啟動工作（建立客戶端、載入索引），讓程序不必等待就能開始接受請求
+# tasks 為 (名稱, 函式) 的列表；函式拋出例外或回傳 None/False 時該項目記為 failed
+# fork 後的子程序呼叫 start() 會重新執行一次，父程序的結果不會沿用
+class WarmUp:
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._status = {}
+        self._started_at = None
+        self._finished_at = None
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._status = {name: {'state': 'pending'} for name, _ in self.tasks}
+            self._started_at = time.monotonic()
+            self._finished_at = None
+        threading.Thread(target=self._run, name="warm-up", daemon=True).start()
+
+    def _run(self):
+        for name, func in self.tasks:
+            start = time.perf_counter()
+            try:
+                result = func()
+                state = {'state': 'ok'} if result not in (None, False) else {'state': 'failed', 'error': '未設定或無法使用'}
+            except Exception as e:
+                print(f"啟動工作 {name} 失敗: {e}")
+                state = {'state': 'failed', 'error': str(e)}
+            state['seconds'] = round(time.perf_counter() - start, 3)
+            with self._lock:
+                self._status[name] = state
+        with self._lock:
+            self._finished_at = time.monotonic()
+
+    def is_ready(self):
+        with self._lock:
+            return (self._pid == os.getpid() and self._finished_at is not None
+                    and all(item['state'] == 'ok' for item in self._status.values()))
+
+    def status(self):
+        with self._lock:
+            started = self._pid == os.getpid()
+            elapsed = None
+            if started:
+                elapsed = round((self._finished_at or time.monotonic()) - self._started_at, 3)
+            return {
+                'started': started,
+                'finished': started and self._finished_at is not None,
+                'seconds': elapsed,
+                'tasks': dict(self._status) if started else {},
+            }
+
+
+clients = ClientManager()
@@ -1,10 +1,13 @@
 import os
-import firebase_admin
-from firebase_admin import credentials, firestore
+from concurrent.futures import ThreadPoolExecutor
+from client_manager import clients
+from metrics import timed
 
 
-# 初始化 Firebase Admin SDK 和 Firestore
+# 初始化 Firebase Admin SDK 和 Firestore；SDK 在第一次建立客戶端時才 import，縮短程序啟動時間
 def initialize_firebase():
+    import firebase_admin
+    from firebase_admin import credentials, firestore
     firebase_credentials_content = os.getenv("FIREBASE_SERVICE_ACCOUNT_KEY")
     if firebase_credentials_content:
         firebase_credentials_path = "/tmp/firebase-credentials.json"
@@ -13,28 +16,85 @@ def initialize_firebase():
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = firebase_credentials_path
 
         cred = credentials.Certificate(firebase_credentials_path)
+        # fork 後的子程序會繼承父程序的 default app，刪除後重新初始化以建立新的連線
+        try:
+            firebase_admin.delete_app(firebase_admin.get_app())
+        except ValueError:
+            pass
         firebase_admin.initialize_app(cred)
         return firestore.client()
     else:
         print("Firebase 金鑰未正確設置，請檢查環境變數")
         return None
 
-# 儲存最愛食譜到 Firestore
-def save_recipe_to_db(db, user_id, dish_name, recipe_text, ingredient_text):
+clients.register("firestore", initialize_firebase)
+
+# 取得共用的 Firestore 客戶端
+def get_db():
+    return clients.get("firestore")
+
+# ASGI 模式建立 AsyncClient 前的準備工作（匯入 SDK、初始化 Firebase Admin SDK 並寫入憑證檔），會阻塞，需在執行緒中執行
+def prepare_async_firestore():
+    from google.cloud.firestore import AsyncClient
+    return get_db()
+
+# ASGI 模式使用的 Firestore AsyncClient，沿用 Firebase Admin SDK 的憑證與專案，建立前先執行 prepare_async_firestore
+def initialize_async_firestore():
+    if get_db() is None:
+        return None
+    import firebase_admin
+    from google.cloud.firestore import AsyncClient
+    app = firebase_admin.get_app()
+    return AsyncClient(project=app.project_id, credentials=app.credential.get_credential())
+
+# 在客戶端預先產生文件 ID（不需要與 Firestore 來回），讓訊息可以先送出、資料稍後再寫入
+def allocate_recipe_ids(db, count):
     try:
-        doc_ref = db.collection('recipes').document()
-        doc_ref.set({
+        return [db.collection('recipes').document().id for _ in range(count)]
+    except Exception as e:
+        print(f"產生食譜 ID 錯誤: {e}")
+        return [None] * count
+
+# 以單一 WriteBatch 寫入多筆食譜，recipes 為 (recipe_id, dish_name, recipe_text, ingredient_text) 的列表
+# dish_type 為生成時要求的料理類型，供本地食譜索引依類型比對
+def build_recipes_batch(db, user_id, recipes, dish_type=None):
+    batch = db.batch()
+    for recipe_id, dish_name, recipe_text, ingredient_text in recipes:
+        if not recipe_id:
+            continue
+        batch.set(db.collection('recipes').document(recipe_id), {
             'user_id': user_id,
             'dish': dish_name,
             'ingredient': ingredient_text,
-            'recipe': recipe_text
+            'recipe': recipe_text,
+            'dish_type': dish_type
         })
-        return doc_ref.id
+    return batch
+
+@timed("firestore_write")
+def save_recipes_batch(db, user_id, recipes, dish_type=None):
+    try:
+        build_recipes_batch(db, user_id, recipes, dish_type).commit()
+        return True
     except Exception as e:
-        print(f"Firestore 插入錯誤: {e}")
-        return None
+        print(f"Firestore 批次寫入錯誤: {e}")
+        return False
+
+# save_recipes_batch 的非同步版本，db 為 AsyncClient
+@timed("firestore_write")
+async def save_recipes_batch_async(db, user_id, recipes, dish_type=None):
+    try:
+        await build_recipes_batch(db, user_id, recipes, dish_type).commit()
+        return True
+    except Exception as e:
+        print(f"Firestore 批次寫入錯誤: {e}")
+        return False
+
+# 背景寫入用的執行緒池，讓回覆訊息不必等待資料庫寫入完成
+write_executor = ThreadPoolExecutor(max_workers=int(os.getenv("FIRESTORE_WRITE_WORKERS", 2)))
 
 # 從 Firestore 根據 recipe_id 查詢食譜
+@timed("firestore_read")
 def get_recipe_from_db(db, recipe_id):
     try:
         recipe_doc = db.collection('recipes').document(recipe_id).get()
@@ -47,43 +107,102 @@ def get_recipe_from_db(db, recipe_id):
         print(f"Firestore 查詢錯誤: {e}")
         return None
 
+@timed("firestore_read")
+async def get_recipe_from_db_async(db, recipe_id):
+    try:
+        recipe_doc = await db.collection('recipes').document(recipe_id).get()
+        if recipe_doc.exists:
+            return recipe_doc.to_dict()
+        else:
+            print("找不到對應的食譜")
+            return None
+    except Exception as e:
+        print(f"Firestore 查詢錯誤: {e}")
+        return None
+
+# 以文件 ID 排序與分頁時使用的特殊欄位名稱
+DOCUMENT_ID = '__name__'
+
+# 收藏列表只需要顯示的欄位，完整食譜內容由詳細頁另外讀取
+FAVORITE_LIST_FIELDS = ['dish', 'ingredient', 'recipe_id']
+
+# 每位使用者的收藏存放在 users/{user_id}/favorites/{recipe_id}，以 recipe_id 作為文件 ID
+def user_favorites_collection(db, user_id):
+    return db.collection('users').document(user_id).collection('favorites')
+
 # 從 Firestore 獲取用戶的收藏食譜
-def get_user_favorites(db, user_id):
+# limit 與 start_after（上一頁最後一筆的文件 ID）用於分頁，fields 用於只讀取部分欄位
+@timed("firestore_read")
+def get_user_favorites(db, user_id, limit=None, start_after=None, fields=None):
     try:
-        favorites_ref = db.collection('favorites').where('user_id', '==', user_id)
+        favorites_ref = user_favorites_collection(db, user_id)
+        if fields:
+            favorites_ref = favorites_ref.select(fields)
+        if limit or start_after:
+            favorites_ref = favorites_ref.order_by(DOCUMENT_ID)
+        if start_after:
+            favorites_ref = favorites_ref.start_after({DOCUMENT_ID: start_after})
+        if limit:
+            favorites_ref = favorites_ref.limit(limit)
         docs = favorites_ref.stream()
         return [{'id': doc.id, **doc.to_dict()} for doc in docs]
     except Exception as e:
         print(f"Firestore 查詢錯誤: {e}")
         return None
 
-# 從 Firestore 刪除指定的收藏食譜
-def delete_favorite_from_db(db, recipe_id):
+# 讀取使用者的單筆收藏
+@timed("firestore_read")
+def get_favorite_from_db(db, user_id, recipe_id):
+    try:
+        favorite_doc = user_favorites_collection(db, user_id).document(recipe_id).get()
+        if favorite_doc.exists:
+            return favorite_doc.to_dict()
+        return None
+    except Exception as e:
+        print(f"Firestore 查詢錯誤: {e}")
+        return None
+
+def favorite_document(user_id, recipe_id, recipe):
+    return {
+        'user_id': user_id,
+        'dish': recipe['dish'],
+        'ingredient': recipe['ingredient'],
+        'recipe': recipe['recipe'],
+        'recipe_id': recipe_id
+    }
+
+# 將食譜加入使用者的收藏；文件 ID 固定為 recipe_id，重複加入只會覆寫同一筆
+@timed("firestore_write")
+def save_favorite_to_db(db, user_id, recipe_id, recipe):
+    try:
+        user_favorites_collection(db, user_id).document(recipe_id).set(favorite_document(user_id, recipe_id, recipe))
+        return True
+    except Exception as e:
+        print(f"Firestore 插入錯誤: {e}")
+        return False
+
+@timed("firestore_write")
+async def save_favorite_to_db_async(db, user_id, recipe_id, recipe):
+    try:
+        await user_favorites_collection(db, user_id).document(recipe_id).set(favorite_document(user_id, recipe_id, recipe))
+        return True
+    except Exception as e:
+        print(f"Firestore 插入錯誤: {e}")
+        return False
+
+# 從 Firestore 刪除使用者指定的收藏食譜；文件不存在時回傳 False
+@timed("firestore_write")
+def delete_favorite_from_db(db, user_id, recipe_id):
+    from google.api_core.exceptions import NotFound
     try:
         print(f"嘗試刪除的食譜 ID: {recipe_id}")
-        
-        # 檢查 recipes 集合中是否存在指定的 recipe_id
-        doc_ref = db.collection('recipes').document(recipe_id)
-        if doc_ref.get().exists:
-            print("找到對應的食譜文檔，繼續查詢 favorites 集合...")
-            
-            # 查詢 favorites 集合中 recipe_id 相符的文檔
-            favorites_ref = db.collection('favorites').where('recipe_id', '==', recipe_id).stream()
-            deleted = False
-            for favorite in favorites_ref:
-                # 刪除 favorites 集合中的文檔
-                db.collection('favorites').document(favorite.id).delete()
-                print(f"已刪除 favorites 集合中的文檔: {favorite.id}")
-                deleted = True
-            
-            if deleted:
-                return True
-            else:
-                print("未找到與該 recipe_id 相符的收藏文檔")
-                return False
-        else:
-            print("找不到對應的食譜文檔")
-            return False
+        doc_ref = user_favorites_collection(db, user_id).document(recipe_id)
+        # exists=True 讓刪除與存在檢查在同一次請求完成
+        doc_ref.delete(option=db.write_option(exists=True))
+        return True
+    except NotFound:
+        print("未找到與該 recipe_id 相符的收藏文檔")
+        return False
     except Exception as e:
         print(f"刪除文檔時發生錯誤: {e}")
         return False
@@ -0,0 +1,164 @@
+import re
+import json
+
+# 預先編譯的 Flex Message 樣板：固定的 bubble / carousel 結構只序列化一次，每則訊息只填入動態欄位
+# 訊息仍以 SDK 公開的 push_message 送出：as_json_dict() 將組好的 JSON 字串以 json.loads 轉回 dict，SDK 再序列化一次，
+# 省去的是 FlexSendMessage 等 model 物件的建立與逐層 as_json_dict 轉換
+# 同時依 LINE 的限制清理、截斷文字，並將超過張數或大小上限的 carousel 拆成多則訊息
+
+# LINE Messaging API 的限制
+MAX_CAROUSEL_BUBBLES = 12
+MAX_BUBBLE_BYTES = 30 * 1024
+MAX_CAROUSEL_BYTES = 50 * 1024
+MAX_ALT_TEXT_CHARS = 400
+MAX_POSTBACK_DATA_CHARS = 300
+MAX_MESSAGES_PER_PUSH = 5
+# 標題與食材文字的字數上限，其餘空間留給食譜內容
+TITLE_MAX_CHARS = 100
+INGREDIENT_MAX_CHARS = 1000
+ELLIPSIS = "…"
+
+PLACEHOLDER_PATTERN = re.compile(r'"__(\w+)__"')
+# 控制字元、零寬字元與單獨的 surrogate 會讓 LINE 拒收訊息，換行與 tab 保留
+INVALID_CHAR_PATTERN = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f​-‏  ﻿\ud800-\udfff]")
+
+
+class FlexTemplate:
+    # skeleton 中值為 "__名稱__" 的字串是動態欄位，其餘部分在建立時就序列化完成
+    def __init__(self, skeleton):
+        compiled = json.dumps(skeleton, ensure_ascii=False, separators=(',', ':'))
+        parts = PLACEHOLDER_PATTERN.split(compiled)
+        self.static_parts = parts[0::2]
+        self.fields = parts[1::2]
+        self.static_size = sum(len(part.encode('utf-8')) for part in self.static_parts)
+
+    # 填入欄位後的 JSON 字串
+    def render(self, **values):
+        pieces = [self.static_parts[0]]
+        for field, static in zip(self.fields, self.static_parts[1:]):
+            pieces.append(json.dumps(values[field], ensure_ascii=False))
+            pieces.append(static)
+        return ''.join(pieces)
+
+    # 只計算提供的欄位，用來估算剩下多少空間可以給其他欄位
+    def size(self, **values):
+        return self.static_size + sum(json_size(value) for field, value in values.items() if field in self.fields)
+
+
+# 不經過 linebot.models 的 Flex 訊息，提供 push_message 需要的 type 與 as_json_dict()
+class FlexMessage:
+    type = 'flex'
+
+    def __init__(self, alt_text, contents_json):
+        self.alt_text = truncate(clean_text(alt_text) or "Flex Message", MAX_ALT_TEXT_CHARS)
+        self.contents_json = contents_json
+
+    def to_json(self):
+        return '{"type":"flex","altText":%s,"contents":%s}' % (json.dumps(self.alt_text, ensure_ascii=False), self.contents_json)
+
+    def as_json_dict(self):
+        return json.loads(self.to_json())
+
+    def __str__(self):
+        return self.to_json()
+
+
+RECIPE_BUBBLE = FlexTemplate({
+    "type": "bubble",
+    "body": {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {"type": "text", "text": "__title__", "wrap": True, "weight": "bold", "size": "xl"},
+            {"type": "text", "text": "__ingredient__", "wrap": True, "margin": "md", "size": "sm"},
+            {"type": "text", "text": "食譜內容：", "wrap": True, "weight": "bold", "size": "lg", "margin": "md"},
+            {"type": "text", "text": "__recipe__", "wrap": True, "margin": "md", "size": "sm"}
+        ]
+    },
+    "footer": {
+        "type": "box",
+        "layout": "vertical",
+        "spacing": "sm",
+        "contents": [
+            {"type": "button", "action": {"type": "postback", "label": "其他食譜", "data": "__new_recipe_data__"},
+             "color": "#474242", "style": "primary", "height": "sm"},
+            {"type": "button", "action": {"type": "postback", "label": "加入我的最愛", "data": "__save_favorite_data__"},
+             "color": "#474242", "style": "primary", "height": "sm"}
+        ]
+    }
+})
+CAROUSEL_PREFIX = '{"type":"carousel","contents":['
+CAROUSEL_SUFFIX = ']}'
+
+
+def json_size(value):
+    return len(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+# 去除 LINE 不接受的字元，統一換行並壓縮過多的空行
+def clean_text(text):
+    text = INVALID_CHAR_PATTERN.sub('', str(text or '')).replace('\r\n', '\n').replace('\r', '\n')
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+def truncate(text, max_chars):
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars - len(ELLIPSIS)] + ELLIPSIS
+
+# 截斷文字，讓序列化後的 JSON 字串不超過 max_bytes
+def truncate_to_bytes(text, max_bytes):
+    if json_size(text) <= max_bytes:
+        return text
+    body = text
+    while body and json_size(body + ELLIPSIS) > max_bytes:
+        # 每個字元序列化後最多 6 bytes，依超出的大小估計一次要去掉的字數
+        overflow = json_size(body + ELLIPSIS) - max_bytes
+        body = body[:len(body) - max(1, overflow // 6)]
+    return body + ELLIPSIS
+
+def postback_data(data):
+    if len(data) > MAX_POSTBACK_DATA_CHARS:
+        raise ValueError(f"postback data 超過 {MAX_POSTBACK_DATA_CHARS} 字元: {data[:50]}...")
+    return data
+
+# context_token 指向伺服器端保存的請求內容（食材、料理類型、已顯示的料理），postback 只需帶短短的 token
+def recipe_bubble(recipe_text, dish_name, ingredient_text, recipe_number, recipe_id, context_token):
+    fields = {
+        'title': truncate(clean_text(f"料理名稱 {recipe_number}：{dish_name}"), TITLE_MAX_CHARS),
+        'ingredient': truncate(clean_text(f"食材：{ingredient_text}"), INGREDIENT_MAX_CHARS),
+        'new_recipe_data': postback_data(f"action=new_recipe&ctx={context_token}"),
+        'save_favorite_data': postback_data(f"action=save_favorite&recipe_id={recipe_id}"),
+    }
+    recipe = clean_text(recipe_text) or "食譜內容缺失"
+    fields['recipe'] = truncate_to_bytes(recipe, MAX_BUBBLE_BYTES - RECIPE_BUBBLE.size(**fields))
+    return RECIPE_BUBBLE.render(**fields)
+
+# 單張 bubble 的 Flex 訊息
+def bubble_message(alt_text, bubble):
+    return FlexMessage(alt_text, bubble)
+
+# 將 bubble 依張數與大小上限分組成一或多則 carousel 訊息，拆成多則時在替代文字後標上頁數
+def carousel_messages(alt_text, bubbles):
+    wrapper_size = len(CAROUSEL_PREFIX) + len(CAROUSEL_SUFFIX)
+    groups = []
+    group, group_size = [], wrapper_size
+    for bubble in bubbles:
+        bubble_size = len(bubble.encode('utf-8')) + (1 if group else 0)
+        if group and (len(group) >= MAX_CAROUSEL_BUBBLES or group_size + bubble_size > MAX_CAROUSEL_BYTES):
+            groups.append(group)
+            group, group_size = [], wrapper_size
+            bubble_size -= 1
+        group.append(bubble)
+        group_size += bubble_size
+    if group:
+        groups.append(group)
+    return [
+        FlexMessage(
+            alt_text if len(groups) == 1 else f"{alt_text}（{i + 1}/{len(groups)}）",
+            CAROUSEL_PREFIX + ','.join(group) + CAROUSEL_SUFFIX
+        )
+        for i, group in enumerate(groups)
+    ]
+
+# 每次 push_message 最多 5 則訊息
+def message_batches(messages):
+    return [messages[i:i + MAX_MESSAGES_PER_PUSH] for i in range(0, len(messages), MAX_MESSAGES_PER_PUSH)]
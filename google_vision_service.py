@@ -1,26 +1,172 @@
 import os
-from google.cloud import vision
-import io
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from cache_service import create_cache
+from client_manager import clients
+from outbound import OutboundPolicy
+from metrics import timed
 
-# 初始化 Google Cloud Vision API 客戶端
-def initialize_vision_client():
+# 以圖片內容雜湊為 key 快取 Vision 辨識結果，重複上傳同一張圖片時不再呼叫 API
+label_cache = create_cache("vision_labels", ttl=float(os.getenv("VISION_CACHE_TTL", 7 * 24 * 60 * 60)))
+# 感知雜湊（dHash）的漢明距離門檻，0 表示停用近似圖片比對
+VISION_PHASH_DISTANCE = int(os.getenv("VISION_PHASH_DISTANCE", 6))
+VISION_PHASH_MAX_SIZE = int(os.getenv("VISION_PHASH_MAX_SIZE", 1024))
+
+# 將環境變數中的服務帳戶金鑰寫入檔案，讓 Google Cloud SDK 以 GOOGLE_APPLICATION_CREDENTIALS 讀取
+def write_google_credentials():
     google_credentials_content = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_CONTENT")
     if google_credentials_content:
         credentials_path = "/tmp/google-credentials.json"
         with open(credentials_path, "w") as f:
             f.write(google_credentials_content)
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
+
+# 初始化 Google Cloud Vision API 客戶端；SDK 在第一次建立客戶端時才 import，縮短程序啟動時間
+def initialize_vision_client():
+    from google.cloud import vision
+    write_google_credentials()
     return vision.ImageAnnotatorClient()
 
+clients.register("vision", initialize_vision_client)
+
+# ASGI 模式建立非同步客戶端前的準備工作（匯入 SDK、寫入憑證檔），會阻塞，需在執行緒中執行
+def prepare_vision_async_client():
+    from google.cloud import vision
+    write_google_credentials()
+
+# ASGI 模式使用的非同步客戶端，需要在事件迴圈中建立，建立前先執行 prepare_vision_async_client
+def initialize_vision_async_client():
+    from google.cloud import vision
+    return vision.ImageAnnotatorAsyncClient()
+
+# Vision 呼叫的限流、重試與斷路器，設定值見 outbound.OutboundPolicy（VISION_ 前綴的環境變數）
+def vision_retryable_errors():
+    from google.api_core import exceptions as google_exceptions
+    return (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+    )
+
+vision_policy = OutboundPolicy("vision", retryable=vision_retryable_errors)
+
+# 計算圖片的 64 位元 dHash；OpenCV 不可用或無法解碼時回傳 None
+def perceptual_hash(image_content):
+    try:
+        import cv2
+        import numpy as np
+        image = cv2.imdecode(np.frombuffer(image_content, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            return None
+        small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+        bits = (small[:, 1:] > small[:, :-1]).flatten()
+        return int(''.join('1' if bit else '0' for bit in bits), 2)
+    except Exception as e:
+        print(f"計算感知雜湊失敗: {e}")
+        return None
+
+# 近似圖片索引：記錄最近的感知雜湊與其內容雜湊，查詢時找漢明距離最近的一張
+class PerceptualIndex:
+    def __init__(self, max_distance=VISION_PHASH_DISTANCE, max_size=VISION_PHASH_MAX_SIZE):
+        self.max_distance = max_distance
+        self.max_size = max_size
+        self._hashes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, phash, content_key):
+        with self._lock:
+            self._hashes[phash] = content_key
+            self._hashes.move_to_end(phash)
+            while len(self._hashes) > self.max_size:
+                self._hashes.popitem(last=False)
+
+    def find(self, phash):
+        best_key, best_distance = None, self.max_distance + 1
+        with self._lock:
+            for candidate, content_key in self._hashes.items():
+                distance = bin(candidate ^ phash).count('1')
+                if distance < best_distance:
+                    best_key, best_distance = content_key, distance
+        return best_key
+
+phash_index = PerceptualIndex()
+
+# 先查內容雜湊，再查近似圖片；都沒有命中時回傳 None
+def get_cached_labels(content_key, phash):
+    labels = label_cache.get(content_key)
+    if labels is None and phash is not None:
+        similar_key = phash_index.find(phash)
+        if similar_key:
+            labels = label_cache.get(similar_key)
+            if labels is not None:
+                print("使用近似圖片的辨識快取")
+    return labels
+
+# 計算圖片的內容雜湊與感知雜湊
+def image_cache_keys(image_content):
+    content_key = hashlib.sha256(image_content).hexdigest()
+    phash = perceptual_hash(image_content) if VISION_PHASH_DISTANCE > 0 else None
+    return content_key, phash
+
+def store_labels(content_key, phash, labels):
+    label_cache.set(content_key, labels)
+    if phash is not None:
+        phash_index.add(phash, content_key)
+
+def parse_label_response(response):
+    if response.error.message:
+        raise Exception(f"Vision API Error: {response.error.message}")
+    return [label.description for label in response.label_annotations]
+
 # 使用 Vision API 進行 Label Detection
+@timed("detect_labels")
 def detect_labels(image_content):
-    try:
-        client = initialize_vision_client()
+    content_key, phash = image_cache_keys(image_content)
+    cached_labels = get_cached_labels(content_key, phash)
+    if cached_labels is not None:
+        return cached_labels
+
+    def label_detection():
+        from google.cloud import vision
+        client = clients.get("vision")
         image = vision.Image(content=image_content)
-        response = client.label_detection(image=image)
-        if response.error.message:
-            raise Exception(f"Vision API Error: {response.error.message}")
-        return [label.description for label in response.label_annotations]
+        return parse_label_response(client.label_detection(image=image, timeout=vision_policy.timeout))
+
+    try:
+        # 同一張圖片同時有多個請求時只呼叫一次 API
+        labels = vision_policy.call(label_detection, key=content_key)
+        store_labels(content_key, phash, labels)
+        return labels
+    except Exception as e:
+        print(f"Google Vision API 錯誤: {str(e)}")
+        return None
+
+# detect_labels 的非同步版本，client 為 ImageAnnotatorAsyncClient
+@timed("detect_labels")
+async def detect_labels_async(client, image_content):
+    # 雜湊計算需要解碼圖片，交給執行緒處理以免阻塞事件迴圈
+    # 快取可能是 sqlite，查詢與寫入也交給執行緒
+    content_key, phash = await asyncio.to_thread(image_cache_keys, image_content)
+    cached_labels = await asyncio.to_thread(get_cached_labels, content_key, phash)
+    if cached_labels is not None:
+        return cached_labels
+
+    async def label_detection():
+        from google.cloud import vision
+        request = vision.AnnotateImageRequest(
+            image=vision.Image(content=image_content),
+            features=[vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION)]
+        )
+        response = await client.batch_annotate_images(requests=[request], timeout=vision_policy.timeout)
+        return parse_label_response(response.responses[0])
+
+    try:
+        labels = await vision_policy.acall(label_detection, key=content_key)
+        await asyncio.to_thread(store_labels, content_key, phash, labels)
+        return labels
     except Exception as e:
         print(f"Google Vision API 錯誤: {str(e)}")
         return None
@@ -0,0 +1,9 @@
+import os
+
+# 以 --preload 啟動時 app 會在 master 中匯入，避免在 fork 之前就建立 gRPC 連線
+os.environ.setdefault("WARM_UP_ON_IMPORT", "0")
+
+# gunicorn 設定：每個 worker 啟動後在背景建立共用的外部服務客戶端並載入食譜索引
+def post_worker_init(worker):
+    from app import startup
+    startup.start()
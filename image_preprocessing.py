@@ -0,0 +1,54 @@
+import os
+import time
+
+# Vision Label Detection 不需要原始解析度，縮小到長邊 IMAGE_MAX_SIDE 後以 JPEG 重新編碼
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", 1024))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 85))
+IMAGE_CHUNK_SIZE = int(os.getenv("IMAGE_CHUNK_SIZE", 64 * 1024))
+
+# 以串流方式讀取 LINE 的圖片內容，只在記憶體中保留一份資料
+def read_message_content(message_content, chunk_size=IMAGE_CHUNK_SIZE):
+    buffer = bytearray()
+    for chunk in message_content.iter_content(chunk_size=chunk_size):
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+# read_message_content 的非同步版本，用於 AsyncLineBotApi 回傳的內容
+async def read_message_content_async(message_content, chunk_size=IMAGE_CHUNK_SIZE):
+    buffer = bytearray()
+    async for chunk in message_content.iter_content(chunk_size=chunk_size):
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+# 縮小並重新編碼圖片（重新編碼的同時會去除 EXIF 等中繼資料）
+# 回傳 (處理後的圖片, 統計資訊)；OpenCV 不可用或處理失敗時回傳原圖
+def preprocess_image(image_content, max_side=IMAGE_MAX_SIDE, quality=IMAGE_JPEG_QUALITY):
+    start = time.perf_counter()
+    stats = {'original_bytes': len(image_content), 'processed_bytes': len(image_content), 'resized': False}
+    processed = image_content
+    try:
+        import cv2
+        import numpy as np
+        image = cv2.imdecode(np.frombuffer(image_content, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("無法解碼圖片")
+        height, width = image.shape[:2]
+        scale = max_side / max(height, width)
+        if scale < 1:
+            image = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+            stats['resized'] = True
+        ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise ValueError("JPEG 編碼失敗")
+        # 重新編碼反而變大時（例如原本就是小張的 JPEG）保留原圖
+        if len(encoded) < len(image_content):
+            processed = encoded.tobytes()
+    except Exception as e:
+        print(f"圖片前處理失敗，使用原始圖片: {e}")
+
+    stats['processed_bytes'] = len(processed)
+    stats['saved_bytes'] = stats['original_bytes'] - stats['processed_bytes']
+    stats['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    print(f"圖片前處理: {stats['original_bytes']} -> {stats['processed_bytes']} bytes，"
+          f"節省 {stats['saved_bytes']} bytes，耗時 {stats['elapsed_ms']} ms")
+    return processed, stats
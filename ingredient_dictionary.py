@@ -0,0 +1,143 @@
+import os
+import json
+import fcntl
+import atexit
+import tempfile
+import threading
+from collections import Counter
+
+# 常見 Vision 標籤的本地翻譯與非食材清單：大部分圖片的標籤都能在本地處理，不必呼叫 LLM 翻譯
+# 可由 INGREDIENT_DICTIONARY_PATH 指定 JSON 檔補充或覆寫，格式為 {"標籤": "中文"}，值為 null 表示非食材
+INGREDIENT_DICTIONARY_PATH = os.getenv("INGREDIENT_DICTIONARY_PATH")
+# 設定後，程序結束時會把觀察到的標籤次數合併寫入此檔案，供 `python ingredient_dictionary.py` 整理字典
+LABEL_STATS_PATH = os.getenv("LABEL_STATS_PATH")
+
+FOOD_TRANSLATIONS = {
+    # 蔬菜
+    'tomato': '番茄', 'cherry tomatoes': '小番茄', 'potato': '馬鈴薯', 'sweet potato': '地瓜', 'carrot': '胡蘿蔔',
+    'onion': '洋蔥', 'red onion': '紫洋蔥', 'green onion': '青蔥', 'scallion': '青蔥', 'spring onion': '青蔥',
+    'leek': '蒜苗', 'garlic': '蒜', 'ginger': '薑', 'cabbage': '高麗菜', 'napa cabbage': '大白菜',
+    'chinese cabbage': '大白菜', 'bok choy': '青江菜', 'broccoli': '綠花椰菜', 'cauliflower': '白花椰菜',
+    'spinach': '菠菜', 'lettuce': '萵苣', 'celery': '芹菜', 'cucumber': '小黃瓜', 'zucchini': '櫛瓜',
+    'eggplant': '茄子', 'bell pepper': '甜椒', 'green bell pepper': '青椒', 'chili pepper': '辣椒',
+    'pumpkin': '南瓜', 'winter squash': '南瓜', 'corn': '玉米', 'sweet corn': '玉米', 'daikon': '白蘿蔔',
+    'radish': '蘿蔔', 'bean sprouts': '豆芽菜', 'asparagus': '蘆筍', 'okra': '秋葵', 'bitter melon': '苦瓜',
+    'taro': '芋頭', 'lotus root': '蓮藕', 'bamboo shoot': '竹筍', 'green bean': '四季豆', 'snow pea': '荷蘭豆',
+    'pea': '豌豆', 'edamame': '毛豆', 'kale': '羽衣甘藍', 'basil': '九層塔', 'coriander': '芫荽', 'cilantro': '芫荽',
+    'mushroom': '菇類', 'shiitake': '香菇', 'enoki mushroom': '金針菇', 'oyster mushroom': '秀珍菇',
+    'king oyster mushroom': '杏鮑菇', 'wood ear': '木耳', 'seaweed': '海帶', 'nori': '海苔',
+    # 肉類、海鮮與蛋
+    'egg': '雞蛋', 'egg yolk': '蛋黃', 'chicken': '雞肉', 'chicken meat': '雞肉', 'chicken breast': '雞胸肉',
+    'chicken thigh': '雞腿', 'pork': '豬肉', 'pork belly': '五花肉', 'pork chop': '豬排', 'beef': '牛肉',
+    'steak': '牛排', 'ground meat': '絞肉', 'lamb': '羊肉', 'mutton': '羊肉', 'duck': '鴨肉', 'bacon': '培根',
+    'ham': '火腿', 'sausage': '香腸', 'fish': '魚', 'salmon': '鮭魚', 'tuna': '鮪魚', 'cod': '鱈魚',
+    'mackerel': '鯖魚', 'shrimp': '蝦子', 'prawn': '蝦子', 'crab': '螃蟹', 'squid': '魷魚', 'octopus': '章魚',
+    'clam': '蛤蜊', 'oyster': '牡蠣', 'scallop': '干貝', 'mussel': '淡菜',
+    # 豆製品、主食與乳製品
+    'tofu': '豆腐', 'dried tofu': '豆干', 'rice': '白飯', 'white rice': '白飯', 'jasmine rice': '白飯',
+    'noodle': '麵條', 'noodles': '麵條', 'udon': '烏龍麵', 'ramen': '拉麵', 'rice noodles': '米粉',
+    'spaghetti': '義大利麵', 'pasta': '義大利麵', 'bread': '麵包', 'toast': '吐司', 'flour': '麵粉',
+    'dumpling': '水餃', 'milk': '牛奶', 'cheese': '起司', 'butter': '奶油', 'yogurt': '優格', 'cream': '鮮奶油',
+    # 水果
+    'apple': '蘋果', 'banana': '香蕉', 'orange': '柳橙', 'lemon': '檸檬', 'lime': '萊姆', 'pineapple': '鳳梨',
+    'mango': '芒果', 'strawberry': '草莓', 'grape': '葡萄', 'kiwifruit': '奇異果', 'avocado': '酪梨',
+    'pear': '梨子', 'peach': '桃子', 'watermelon': '西瓜', 'papaya': '木瓜', 'guava': '芭樂',
+}
+
+# Vision 常見但不是食材的標籤：餐具、場景、材質，以及「食物」「蔬菜」這類泛稱
+NON_FOOD_LABELS = {
+    'food', 'ingredient', 'recipe', 'cuisine', 'dish', 'meal', 'produce', 'vegetable', 'fruit', 'natural foods',
+    'whole food', 'local food', 'staple food', 'superfood', 'vegan nutrition', 'vegetarian food', 'leaf vegetable',
+    'root vegetable', 'cruciferous vegetables', 'plant', 'flowering plant', 'seedless fruit', 'citrus', 'meat',
+    'red meat', 'seafood', 'animal product', 'fast food', 'comfort food', 'finger food', 'junk food', 'cooking',
+    'tableware', 'dishware', 'serveware', 'plate', 'bowl', 'mixing bowl', 'cup', 'drinkware', 'cutlery', 'fork',
+    'spoon', 'knife', 'kitchen utensil', 'cookware and bakeware', 'cutting board', 'countertop', 'table',
+    'kitchen', 'kitchen appliance', 'refrigerator', 'home appliance', 'wood', 'hardwood', 'rectangle', 'circle',
+    'still life photography', 'still life', 'close-up', 'macro photography', 'font', 'logo', 'plastic', 'glass',
+    'packaging and labeling', 'box', 'bag', 'bottle', 'tin', 'metal', 'wrap', 'tablecloth', 'textile', 'room',
+    'interior design', 'shelf', 'window', 'hand', 'finger', 'nail', 'gesture', 'person', 'event', 'art',
+}
+
+_custom_translations = {}
+_custom_non_food = set()
+if INGREDIENT_DICTIONARY_PATH and os.path.exists(INGREDIENT_DICTIONARY_PATH):
+    try:
+        with open(INGREDIENT_DICTIONARY_PATH, encoding='utf-8') as f:
+            for label, translation in json.load(f).items():
+                if translation:
+                    _custom_translations[label.strip().lower()] = translation
+                else:
+                    _custom_non_food.add(label.strip().lower())
+    except Exception as e:
+        print(f"載入食材字典失敗: {e}")
+
+# 觀察到的標籤次數，以及其中不在字典中的標籤次數
+label_counts = Counter()
+unknown_label_counts = Counter()
+stats_lock = threading.Lock()
+
+def lookup_label(label):
+    key = label.strip().lower()
+    if key in _custom_non_food:
+        return None, True
+    translation = _custom_translations.get(key) or FOOD_TRANSLATIONS.get(key)
+    if translation:
+        return translation, True
+    return None, key in NON_FOOD_LABELS
+
+# 將標籤分成本地已翻譯的食材（去除重複並保留順序）與字典中沒有的標籤；非食材標籤直接捨棄
+def split_labels(labels):
+    known = []
+    unknown = []
+    for label in labels:
+        translation, found = lookup_label(label)
+        if translation and translation not in known:
+            known.append(translation)
+        elif not found and label not in unknown:
+            unknown.append(label)
+    with stats_lock:
+        label_counts.update(label.strip().lower() for label in labels)
+        unknown_label_counts.update(label.strip().lower() for label in unknown)
+    return known, unknown
+
+# 多個 worker 可能同時結束：以檔案鎖讓讀取、合併、寫入依序進行，並先寫入暫存檔再以 os.replace 替換，
+# 其他程序不會讀到寫到一半的檔案
+def save_label_stats(path=LABEL_STATS_PATH):
+    if not path:
+        return
+    try:
+        with open(f"{path}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            stats = {'labels': {}, 'unknown': {}}
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as f:
+                    stats = json.load(f)
+            with stats_lock:
+                merged_labels = Counter(stats.get('labels', {})) + label_counts
+                merged_unknown = Counter(stats.get('unknown', {})) + unknown_label_counts
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump({'labels': merged_labels, 'unknown': merged_unknown}, f, ensure_ascii=False, indent=2)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+    except Exception as e:
+        print(f"儲存標籤統計失敗: {e}")
+
+atexit.register(save_label_stats)
+
+
+if __name__ == "__main__":
+    # 列出最常出現但字典中沒有的標籤：python ingredient_dictionary.py label_stats.json [數量]
+    import sys
+    stats_path = sys.argv[1] if len(sys.argv) > 1 else LABEL_STATS_PATH
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    with open(stats_path, encoding='utf-8') as f:
+        stats = json.load(f)
+    total = sum(stats.get('labels', {}).values()) or 1
+    for label, count in Counter(stats.get('unknown', {})).most_common(top):
+        # 已經加入字典的標籤不再列出
+        if not lookup_label(label)[1]:
+            print(f"{count:>8}  {count / total:6.1%}  {label}")
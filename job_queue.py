@@ -0,0 +1,92 @@
+import os
+import queue
+import threading
+
+# 背景工作佇列設定（皆可由環境變數調整）
+JOB_QUEUE_WORKERS = int(os.getenv("JOB_QUEUE_WORKERS", 4))
+JOB_QUEUE_MAX_SIZE = int(os.getenv("JOB_QUEUE_MAX_SIZE", 100))
+# 佇列已滿時的處理方式：block（等待 JOB_QUEUE_PUT_TIMEOUT 秒）、reject（立即拒絕）、inline（在當前執行緒直接執行）
+JOB_QUEUE_FULL_POLICY = os.getenv("JOB_QUEUE_FULL_POLICY", "block")
+JOB_QUEUE_PUT_TIMEOUT = float(os.getenv("JOB_QUEUE_PUT_TIMEOUT", 2))
+
+
+class JobQueue:
+    def __init__(self, workers=JOB_QUEUE_WORKERS, max_size=JOB_QUEUE_MAX_SIZE,
+                 full_policy=JOB_QUEUE_FULL_POLICY, put_timeout=JOB_QUEUE_PUT_TIMEOUT):
+        self.workers = max(1, workers)
+        self.max_size = max_size
+        self.full_policy = full_policy
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    # 延遲啟動工作執行緒；gunicorn preload 後 fork 出的子程序沒有父程序的執行緒，需重新啟動
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_size)
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def _worker(self):
+        while True:
+            func, args, kwargs = self._queue.get()
+            try:
+                func(*args, **kwargs)
+                with self._lock:
+                    self.completed += 1
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                print(f"背景工作執行錯誤: {e}")
+            finally:
+                self._queue.task_done()
+
+    # 放入一個工作；回傳 False 代表佇列已滿且工作被拒絕
+    def submit(self, func, *args, **kwargs):
+        self._ensure_started()
+        job = (func, args, kwargs)
+        try:
+            if self.full_policy == "block":
+                self._queue.put(job, timeout=self.put_timeout)
+            else:
+                self._queue.put_nowait(job)
+        except queue.Full:
+            if self.full_policy == "inline":
+                func(*args, **kwargs)
+                return True
+            with self._lock:
+                self.rejected += 1
+            print(f"背景工作佇列已滿（{self.max_size}），拒絕新的工作")
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'max_size': self.max_size,
+            'depth': self._queue.qsize(),
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'completed': self.completed,
+            'failed': self.failed,
+        }
+
+
+# 全程序共用的背景工作佇列
+job_queue = JobQueue()
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import uuid
+import inspect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# 各階段耗時與 OpenAI 用量的統計，以 Prometheus 文字格式輸出於 /metrics
+# 統計值保存在各自的程序中，多個 gunicorn worker 時每次抓取只會看到其中一個 worker 的數值
+METRICS_LOG_FORMAT = os.getenv("METRICS_LOG_FORMAT", "text")
+# 耗時直方圖的上限（秒）
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+# 目前處理中的事件 ID，讓同一個事件各階段的 JSON log 可以串起來
+trace_id = contextvars.ContextVar("trace_id", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=STAGE_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    # 回傳指定直方圖各組標籤的 (標籤 dict, 次數, 總和)
+    def summaries(self, name):
+        with self._lock:
+            return [
+                (dict(labels), histogram.count, histogram.sum)
+                for (histogram_name, labels), histogram in self._histograms.items() if histogram_name == name
+            ]
+
+    # 輸出 Prometheus 文字格式；gauges 為 (名稱, 標籤 dict, 數值) 的列表，由呼叫端在抓取時提供
+    def render(self, gauges=()):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            for (name, labels), value in counters:
+                add_type(lines, name, 'counter')
+                lines.append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in histograms:
+                add_type(lines, name, 'histogram')
+                # counts 已是累積值（每個 bucket 計入所有小於等於上限的觀測值）
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        for name, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+            add_type(lines, name, 'gauge')
+            lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+# 同名的指標只在第一次出現時加上 TYPE 說明
+def add_type(lines, name, kind):
+    line = f"# TYPE {name} {kind}"
+    if line not in lines:
+        lines.append(line)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+# 全程序共用的統計
+metrics = Metrics()
+
+# METRICS_LOG_FORMAT=json 時輸出一行 JSON，否則不輸出
+def log_event(event, **fields):
+    if METRICS_LOG_FORMAT != "json":
+        return
+    record = {'event': event, 'time': round(time.time(), 3), 'trace_id': trace_id.get(), **fields}
+    print(json.dumps(record, ensure_ascii=False, default=str))
+
+# 為接下來的處理建立新的 trace ID
+def start_trace():
+    trace_id.set(uuid.uuid4().hex[:16])
+
+# 記錄一個階段的耗時，發生例外時另外累計錯誤次數
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        metrics.increment("foodlens_stage_errors_total", stage=name)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        metrics.observe("foodlens_stage_duration_seconds", duration, stage=name)
+        log_event("stage", stage=name, duration_ms=round(duration * 1000, 1), error=error)
+
+# 以 stage 包住整個函式，同時支援一般函式與 coroutine function
+def timed(name):
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# 累計 OpenAI 的 token 用量；source 標示來源是 API 回傳的 usage（api）或依文字長度估計（estimated）
+def record_token_usage(task, usage, estimated=False):
+    if not usage:
+        return
+    source = 'estimated' if estimated else 'api'
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        if usage.get(kind):
+            metrics.increment("foodlens_openai_tokens_total", usage[kind], task=task, type=kind.replace('_tokens', ''), source=source)
+    log_event("openai_usage", task=task, source=source, **dict(usage))
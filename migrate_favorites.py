@@ -0,0 +1,50 @@
+import argparse
+from dotenv import load_dotenv
+from firebase_service import get_db, user_favorites_collection
+
+# Firestore 單一 WriteBatch 最多 500 個寫入
+BATCH_SIZE = 500
+
+# 將舊的 favorites 集合搬移到 users/{user_id}/favorites/{recipe_id}
+# 同一使用者重複收藏同一道食譜的多筆舊資料會合併成一筆
+def migrate_favorites(db, delete_old=False, dry_run=False):
+    migrated = 0
+    skipped = 0
+    batch = db.batch()
+    pending = 0
+
+    for doc in db.collection('favorites').stream():
+        favorite = doc.to_dict()
+        user_id = favorite.get('user_id')
+        recipe_id = favorite.get('recipe_id')
+        if not user_id or not recipe_id:
+            print(f"略過缺少 user_id 或 recipe_id 的文檔: {doc.id}")
+            skipped += 1
+            continue
+
+        migrated += 1
+        if dry_run:
+            continue
+        batch.set(user_favorites_collection(db, user_id).document(recipe_id), favorite, merge=True)
+        pending += 1
+        if delete_old:
+            batch.delete(doc.reference)
+            pending += 1
+        if pending >= BATCH_SIZE - 1:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    if pending:
+        batch.commit()
+    print(f"搬移完成：{migrated} 筆，略過 {skipped} 筆{'（dry run，未寫入）' if dry_run else ''}")
+    return migrated, skipped
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="將 favorites 集合搬移到每位使用者的子集合")
+    parser.add_argument("--delete-old", action="store_true", help="搬移後刪除舊的 favorites 文檔")
+    parser.add_argument("--dry-run", action="store_true", help="只統計數量，不寫入任何資料")
+    args = parser.parse_args()
+    migrate_favorites(get_db(), delete_old=args.delete_old, dry_run=args.dry_run)
@@ -0,0 +1,290 @@
+import os
+import time
+import random
+import asyncio
+import threading
+
+
+# 斷路器開啟時直接拒絕呼叫
+class CircuitOpenError(Exception):
+    pass
+
+
+# 令牌桶限流：每秒補充 rate 個令牌，最多累積 burst 個
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # 嘗試取得一個令牌，成功回傳 0，否則回傳需要等待的秒數
+    def try_acquire(self):
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    # 取得一個令牌；超過 timeout 秒仍無法取得時回傳 False
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+
+# 斷路器：連續失敗 failure_threshold 次後開啟，reset_timeout 秒後放行一個試探請求（half-open）
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.state = 'closed'
+        self._opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = 'half-open'
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = 'closed'
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+    # 試探請求沒有得到結果（例如被取消）時重新開啟，reset_timeout 秒後再放行下一個試探請求
+    def abort_probe(self):
+        with self._lock:
+            if self.state == 'half-open':
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+
+# 合併相同 key 的同時請求：只有第一個呼叫真正執行，其他呼叫等待並共用結果
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if not leader:
+                self.coalesced += 1
+            else:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = func()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['event'].set()
+
+
+# SingleFlight 的 asyncio 版本，等待中的呼叫不佔用執行緒
+class AsyncSingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, func):
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await func()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # 沒有其他呼叫在等待時，避免出現 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            self._calls.pop(key, None)
+
+
+# 對外呼叫的共用策略：限流、併發上限、斷路器、指數退避重試與相同請求合併
+# 設定值可由 <NAME>_RATE_PER_SEC、<NAME>_BURST、<NAME>_MAX_CONCURRENCY、<NAME>_MAX_RETRIES、
+# <NAME>_TIMEOUT、<NAME>_BREAKER_THRESHOLD、<NAME>_BREAKER_RESET 環境變數調整
+class OutboundPolicy:
+    def __init__(self, name, retryable=(Exception,), rate=None, burst=None, concurrency=None,
+                 retries=None, timeout=None, base_delay=0.5, max_delay=8):
+        prefix = name.upper()
+        setting = lambda key, default: float(os.getenv(f"{prefix}_{key}", default))
+        self.name = name
+        # retryable 可以是例外類別的 tuple，或回傳 tuple 的函式（第一次用到時才 import 對應的 SDK）
+        self._retryable = retryable
+        self.timeout = timeout if timeout is not None else setting("TIMEOUT", 30)
+        self.retries = int(retries if retries is not None else setting("MAX_RETRIES", 3))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bucket = TokenBucket(
+            rate if rate is not None else setting("RATE_PER_SEC", 5),
+            int(burst if burst is not None else setting("BURST", 10))
+        )
+        self.concurrency = int(concurrency if concurrency is not None else setting("MAX_CONCURRENCY", 8))
+        self._semaphore = threading.BoundedSemaphore(self.concurrency)
+        self.breaker = CircuitBreaker(int(setting("BREAKER_THRESHOLD", 5)), setting("BREAKER_RESET", 30))
+        self.single_flight = SingleFlight()
+        self.async_single_flight = AsyncSingleFlight()
+        self._async_semaphore = None
+        self.stats = {'calls': 0, 'retries': 0, 'failures': 0, 'rejected': 0}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def retryable(self):
+        if callable(self._retryable) and not isinstance(self._retryable, type):
+            self._retryable = tuple(self._retryable())
+        return self._retryable
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['coalesced'] = self.single_flight.coalesced + self.async_single_flight.coalesced
+        stats['breaker_state'] = self.breaker.state
+        return stats
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    # 執行 func；提供 key 時，相同 key 的同時請求只會呼叫一次
+    def call(self, func, key=None):
+        if key is None:
+            return self._call_with_retries(func)
+        return self.single_flight.do(key, lambda: self._call_with_retries(func))
+
+    def _call_with_retries(self, func):
+        for attempt in range(self.retries + 1):
+            # 等待令牌與併發名額的時間也受 timeout 限制，避免請求無限排隊
+            # 取得之後才詢問斷路器，half-open 放行的試探請求一定會執行 func 並回報結果
+            if not self.bucket.acquire(timeout=self.timeout):
+                self._count('rejected')
+                raise TimeoutError(f"{self.name} 限流等待逾時")
+            if not self._semaphore.acquire(timeout=self.timeout):
+                self._count('rejected')
+                raise TimeoutError(f"{self.name} 併發名額等待逾時")
+            if not self.breaker.allow():
+                self._semaphore.release()
+                self._count('rejected')
+                raise CircuitOpenError(f"{self.name} 斷路器開啟中，暫停呼叫")
+            try:
+                self._count('calls')
+                result = func()
+                self.breaker.record_success()
+                return result
+            except self.retryable as e:
+                self.breaker.record_failure()
+                if attempt >= self.retries:
+                    self._count('failures')
+                    raise
+                self._count('retries')
+                # full jitter：在 0 到指數退避上限之間隨機等待
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+                print(f"{self.name} 呼叫失敗（{e}），{delay:.1f} 秒後重試")
+            except Exception:
+                # 不可重試的錯誤（例如參數錯誤）代表服務有回應，不計入斷路器失敗
+                self.breaker.record_success()
+                raise
+            except BaseException:
+                # 沒有得到結果（例如 KeyboardInterrupt），不計入成功或失敗
+                self.breaker.abort_probe()
+                raise
+            finally:
+                self._semaphore.release()
+            time.sleep(delay)
+
+    # call 的非同步版本：func 為 coroutine function，等待令牌、併發名額與退避時都不佔用執行緒
+    async def acall(self, func, key=None):
+        if key is None:
+            return await self._acall_with_retries(func)
+        return await self.async_single_flight.do(key, lambda: self._acall_with_retries(func))
+
+    async def _acall_with_retries(self, func):
+        if self._async_semaphore is None:
+            self._async_semaphore = asyncio.Semaphore(self.concurrency)
+        for attempt in range(self.retries + 1):
+            if not await self.bucket.acquire_async(timeout=self.timeout):
+                self._count('rejected')
+                raise TimeoutError(f"{self.name} 限流等待逾時")
+            try:
+                await asyncio.wait_for(self._async_semaphore.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                self._count('rejected')
+                raise TimeoutError(f"{self.name} 併發名額等待逾時")
+            if not self.breaker.allow():
+                self._async_semaphore.release()
+                self._count('rejected')
+                raise CircuitOpenError(f"{self.name} 斷路器開啟中，暫停呼叫")
+            try:
+                self._count('calls')
+                result = await func()
+                self.breaker.record_success()
+                return result
+            except self.retryable as e:
+                self.breaker.record_failure()
+                if attempt >= self.retries:
+                    self._count('failures')
+                    raise
+                self._count('retries')
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+                print(f"{self.name} 呼叫失敗（{e}），{delay:.1f} 秒後重試")
+            except Exception:
+                self.breaker.record_success()
+                raise
+            except BaseException:
+                # 包含 task 被取消（CancelledError）的情況
+                self.breaker.abort_probe()
+                raise
+            finally:
+                self._async_semaphore.release()
+            await asyncio.sleep(delay)
@@ -0,0 +1,51 @@
+import os
+import hashlib
+import threading
+from cache_service import create_cache
+from recipe_index import tokenize_ingredients, normalize_dish_type, COUNT_PATTERN
+
+# 食譜生成快取：以正規化後的（料理類型, 食材集合）為 key，每個 key 保存多道候選食譜
+RECIPE_CACHE_VARIANTS = int(os.getenv("RECIPE_CACHE_VARIANTS", 5))
+generation_cache = create_cache(
+    "recipe_generation",
+    max_size=int(os.getenv("RECIPE_CACHE_MAX_SIZE", 2000)),
+    ttl=float(os.getenv("RECIPE_CACHE_TTL", 3 * 24 * 60 * 60))
+)
+
+# 以請求為單位的命中統計（至少取得一道快取食譜即算命中）
+cache_stats = {'requests': 0, 'hits': 0}
+stats_lock = threading.Lock()
+
+def get_generation_cache_stats():
+    with stats_lock:
+        stats = dict(cache_stats)
+    stats['hit_rate'] = stats['hits'] / stats['requests'] if stats['requests'] else 0.0
+    stats['size'] = len(generation_cache)
+    return stats
+
+def generation_cache_key(dish_type, ingredients):
+    key = normalize_dish_type(dish_type) + '|' + ','.join(sorted(tokenize_ingredients(ingredients)))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+# 取得尚未出現在 exclude_dishes 的快取食譜，最多 limit 道
+# 回傳 (料理名稱, 食材, 食譜內容, recipe_id) 的列表；取出的食譜會移到最後，下次優先提供其他變化
+def get_cached_recipes(dish_type, ingredients, limit, exclude_dishes=None):
+    key = generation_cache_key(dish_type, ingredients)
+    variants = [tuple(variant) for variant in generation_cache.get(key) or []]
+    exclude_dishes = set(exclude_dishes or [])
+    served = [variant for variant in variants if variant[0] not in exclude_dishes][:limit]
+    with stats_lock:
+        cache_stats['requests'] += 1
+        cache_stats['hits'] += 1 if served else 0
+    if served:
+        rotated = [variant for variant in variants if variant not in served] + served
+        generation_cache.set(key, rotated)
+    return served
+
+# 將已指派 recipe_id 的食譜加入快取，同名料理只保留一份，超過上限時淘汰最舊的
+def add_cached_recipes(dish_type, ingredients, recipes):
+    key = generation_cache_key(dish_type, ingredients)
+    recipes = [tuple(recipe) for recipe in recipes if recipe[3]]
+    new_names = {recipe[0] for recipe in recipes}
+    variants = [tuple(variant) for variant in generation_cache.get(key) or [] if variant[0] not in new_names]
+    generation_cache.set(key, (variants + recipes)[-RECIPE_CACHE_VARIANTS:])
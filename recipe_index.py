@@ -0,0 +1,198 @@
+import os
+import re
+import json
+import math
+import threading
+
+# 本地食譜索引：以食材為 key 的倒排索引，在呼叫 GPT-4 之前先找看看已經生成過的相符食譜
+RECIPE_INDEX_SNAPSHOT = os.getenv("RECIPE_INDEX_SNAPSHOT")
+# 啟動時是否從 Firestore 的 recipes 集合建立索引（每個 worker 都會讀取整個集合，預設關閉）
+RECIPE_INDEX_FROM_FIRESTORE = os.getenv("RECIPE_INDEX_FROM_FIRESTORE", "0") == "1"
+# 食譜所需食材中使用者擁有的比例下限，以及至少要有幾項相同食材才算強相符
+RECIPE_INDEX_MIN_COVERAGE = float(os.getenv("RECIPE_INDEX_MIN_COVERAGE", 0.8))
+RECIPE_INDEX_MIN_SHARED = int(os.getenv("RECIPE_INDEX_MIN_SHARED", 2))
+
+# 常見的同義詞，統一成同一個詞
+SYNONYMS = {
+    '蕃茄': '番茄', '西紅柿': '番茄', '蛋': '雞蛋', '土豆': '馬鈴薯', '洋芋': '馬鈴薯',
+    '包心菜': '高麗菜', '捲心菜': '高麗菜', '甘藍': '高麗菜', '青椒': '甜椒', '彩椒': '甜椒',
+    '蔥': '青蔥', '大蒜': '蒜', '蒜頭': '蒜', '生薑': '薑', '老薑': '薑', '香菜': '芫荽',
+    '豬五花': '五花肉', '牛肉片': '牛肉', '豬肉片': '豬肉', '雞腿肉': '雞腿', '板豆腐': '豆腐',
+    '嫩豆腐': '豆腐', '米飯': '白飯', '飯': '白飯', '麵': '麵條', '紅蘿蔔': '胡蘿蔔',
+}
+# 調味料與常備材料不納入比對，避免每道食譜都因為「鹽、油」而相符
+PANTRY = {
+    '鹽', '糖', '油', '食用油', '沙拉油', '橄欖油', '麻油', '香油', '醬油', '醋', '米酒', '料理酒',
+    '胡椒', '胡椒粉', '白胡椒', '黑胡椒', '太白粉', '水', '清水', '味精', '雞粉', '蠔油', '砂糖', '冰糖',
+}
+
+# 數量與單位，例如「2顆」「1/2 小匙」「300g」「適量」
+QUANTITY_PATTERN = re.compile(
+    r"[\d０-９一二兩三四五六七八九十半\.\/]+\s*"
+    r"(?:公克|克|g|kg|毫升|ml|顆|個|片|根|條|支|大匙|小匙|茶匙|湯匙|匙|杯|碗|塊|把|瓣|包|罐|盒|斤|兩|隻|尾|朵)?"
+    r"|適量|少許|少量|些許|約",
+    re.IGNORECASE
+)
+SEPARATOR_PATTERN = re.compile(r"[、，,；;：:/／\n\r\t]+|\s+|和|及|與")
+COUNT_PATTERN = re.compile(r"(?:\d+|[零一二兩三四五六七八九十幾])\s*道菜?")
+# 沒有指定料理類型時的料理類型，比對索引時不限制類型
+GENERIC_DISH_TYPES = {"料理", "新的食譜"}
+
+# 「中式料理兩道」「中式 2 道」「中式菜」都視為「中式」
+def normalize_dish_type(dish_type):
+    dish_type = COUNT_PATTERN.sub('', dish_type or '')
+    dish_type = re.sub(r"[\s\W_]+", '', dish_type)
+    dish_type = re.sub(r"(?:料理|菜色|菜|餐點|餐)$", '', dish_type)
+    return dish_type or "料理"
+
+# 將食材文字轉成正規化後的食材集合
+def tokenize_ingredients(text):
+    if isinstance(text, (list, tuple, set)):
+        text = '、'.join(text)
+    text = re.sub(r"[（(][^）)]*[）)]", '', text or '')
+    tokens = set()
+    for part in SEPARATOR_PATTERN.split(text):
+        part = QUANTITY_PATTERN.sub('', part)
+        part = re.sub(r"[\W_]+", '', part).lower()
+        if not part:
+            continue
+        part = SYNONYMS.get(part, part)
+        if part not in PANTRY:
+            tokens.add(part)
+    return tokens
+
+
+class RecipeIndex:
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._docs = {}
+        self._postings = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    # 新增或更新一道食譜；dish_type 為生成時要求的料理類型，舊資料沒有時為 None
+    def add(self, recipe_id, dish, ingredient, recipe, dish_type=None):
+        tokens = tokenize_ingredients(ingredient)
+        if not recipe_id or not tokens:
+            return
+        dish_type = normalize_dish_type(dish_type) if dish_type else None
+        with self._lock:
+            self._remove(recipe_id)
+            self._docs[recipe_id] = {
+                'dish': dish, 'ingredient': ingredient, 'recipe': recipe, 'tokens': tokens, 'dish_type': dish_type
+            }
+            self._total_length += len(tokens)
+            for token in tokens:
+                self._postings.setdefault(token, set()).add(recipe_id)
+
+    def _remove(self, recipe_id):
+        doc = self._docs.pop(recipe_id, None)
+        if doc is None:
+            return
+        self._total_length -= len(doc['tokens'])
+        for token in doc['tokens']:
+            postings = self._postings.get(token)
+            if postings:
+                postings.discard(recipe_id)
+                if not postings:
+                    del self._postings[token]
+
+    # 依 BM25 排序相符的食譜（Jaccard 作為次要排序），只回傳達到強相符門檻的結果
+    # 指定了料理類型（例如「日式」）時只比對同類型的食譜，沒有記錄類型的舊食譜不列入
+    # 回傳 (recipe_id, dish, ingredient, recipe) 的列表
+    def search(self, ingredients, limit=1, exclude_dishes=None, dish_type=None,
+               min_coverage=RECIPE_INDEX_MIN_COVERAGE, min_shared=RECIPE_INDEX_MIN_SHARED):
+        query = tokenize_ingredients(ingredients)
+        exclude_dishes = set(exclude_dishes or [])
+        dish_type = normalize_dish_type(dish_type) if dish_type else None
+        if dish_type in GENERIC_DISH_TYPES:
+            dish_type = None
+        with self._lock:
+            if not query or not self._docs:
+                return []
+            total_docs = len(self._docs)
+            average_length = self._total_length / total_docs
+            candidates = set()
+            for token in query:
+                candidates |= self._postings.get(token, set())
+
+            scored = []
+            for recipe_id in candidates:
+                doc = self._docs[recipe_id]
+                if doc['dish'] in exclude_dishes or (dish_type and doc['dish_type'] != dish_type):
+                    continue
+                shared = query & doc['tokens']
+                if len(shared) < min_shared or len(shared) / len(doc['tokens']) < min_coverage:
+                    continue
+                length_norm = self.k1 * (1 - self.b + self.b * len(doc['tokens']) / average_length)
+                bm25 = 0.0
+                for token in shared:
+                    doc_freq = len(self._postings[token])
+                    idf = math.log(1 + (total_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+                    bm25 += idf * (self.k1 + 1) / (1 + length_norm)
+                jaccard = len(shared) / len(query | doc['tokens'])
+                scored.append((bm25, jaccard, recipe_id))
+
+            scored.sort(reverse=True)
+            results = []
+            for _, _, recipe_id in scored[:limit]:
+                doc = self._docs[recipe_id]
+                results.append((recipe_id, doc['dish'], doc['ingredient'], doc['recipe']))
+            return results
+
+    # 匯出成 JSON Lines 快照，供離線環境載入
+    def export_snapshot(self, path):
+        with self._lock:
+            docs = list(self._docs.items())
+        with open(path, 'w', encoding='utf-8') as f:
+            for recipe_id, doc in docs:
+                f.write(json.dumps({
+                    'id': recipe_id, 'dish': doc['dish'], 'ingredient': doc['ingredient'], 'recipe': doc['recipe'],
+                    'dish_type': doc['dish_type']
+                }, ensure_ascii=False) + '\n')
+
+    def load_snapshot(self, path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    self.add(item['id'], item.get('dish'), item.get('ingredient'), item.get('recipe'), item.get('dish_type'))
+
+    # 從 Firestore 的 recipes 集合建立索引
+    def load_firestore(self, db):
+        docs = db.collection('recipes').select(['dish', 'ingredient', 'recipe', 'dish_type']).stream()
+        for doc in docs:
+            recipe = doc.to_dict()
+            self.add(doc.id, recipe.get('dish'), recipe.get('ingredient'), recipe.get('recipe'), recipe.get('dish_type'))
+
+
+# 全程序共用的食譜索引
+recipe_index = RecipeIndex()
+
+def load_recipe_index(db=None):
+    try:
+        if RECIPE_INDEX_SNAPSHOT and os.path.exists(RECIPE_INDEX_SNAPSHOT):
+            recipe_index.load_snapshot(RECIPE_INDEX_SNAPSHOT)
+        elif RECIPE_INDEX_FROM_FIRESTORE and db is not None:
+            recipe_index.load_firestore(db)
+        print(f"食譜索引載入完成，共 {len(recipe_index)} 道食譜")
+        return True
+    except Exception as e:
+        print(f"載入食譜索引失敗: {e}")
+        return False
+
+
+if __name__ == "__main__":
+    # 從 Firestore 匯出快照：python recipe_index.py recipes.jsonl
+    import sys
+    from dotenv import load_dotenv
+    from firebase_service import get_db
+    load_dotenv()
+    output_path = sys.argv[1] if len(sys.argv) > 1 else "recipes.jsonl"
+    recipe_index.load_firestore(get_db())
+    recipe_index.export_snapshot(output_path)
+    print(f"已匯出 {len(recipe_index)} 道食譜到 {output_path}")
@@ -0,0 +1,46 @@
+import os
+import secrets
+from cache_service import create_cache
+
+# 使用者對話狀態的儲存：預設使用 sqlite，讓同一台機器上的所有 gunicorn worker 共用
+SESSION_STORE_BACKEND = os.getenv("SESSION_STORE_BACKEND", "sqlite")
+SESSION_TTL = float(os.getenv("SESSION_TTL", 24 * 60 * 60))
+SESSION_MAX_SIZE = int(os.getenv("SESSION_MAX_SIZE", 10000))
+
+# 建立具 TTL 與容量上限的 session store，介面與快取相同（get / set / delete / stats）
+def create_session_store(name, ttl=SESSION_TTL, max_size=SESSION_MAX_SIZE):
+    return create_cache(name, backend=SESSION_STORE_BACKEND, max_size=max_size, ttl=ttl)
+
+
+# 「其他食譜」按鈕引用的請求內容，postback 只帶短 token，伺服器端以 O(1) 查回
+REQUEST_CONTEXT_TTL = float(os.getenv("REQUEST_CONTEXT_TTL", 7 * 24 * 60 * 60))
+request_contexts = create_session_store("request_contexts", ttl=REQUEST_CONTEXT_TTL)
+
+def save_request_context(context):
+    token = secrets.token_urlsafe(8)
+    request_contexts.set(token, context)
+    return token
+
+def load_request_context(token):
+    return request_contexts.get(token)
+
+def update_request_context(token, context):
+    request_contexts.set(token, context)
+
+
+# /api/favorites 的分頁回應快取，每一頁各自一個 key
+# 加入收藏的 postback 可能由另一個 worker 處理，因此放在所有 worker 共用的 store，失效才會對每個 worker 生效
+FAVORITES_CACHE_TTL = float(os.getenv("FAVORITES_CACHE_TTL", 30))
+favorites_cache = create_session_store("favorites_api", ttl=FAVORITES_CACHE_TTL)
+# 每位使用者收藏列表的世代，新增或刪除收藏時換成新的值；分頁的 key 包含世代，
+# 失效前讀取 Firestore、失效後才寫回快取的舊分頁存在舊世代的 key 下，不會再被讀到
+favorites_generations = create_session_store("favorites_generations")
+# 尚未失效過的使用者使用初始世代；讀取時不寫入世代，避免覆蓋同時發生的失效
+INITIAL_FAVORITES_GENERATION = "0"
+
+def favorites_page_key(user_id, limit, start_after):
+    generation = favorites_generations.get(user_id) or INITIAL_FAVORITES_GENERATION
+    return f"{user_id}|{generation}|{limit}|{start_after or ''}"
+
+def invalidate_favorites_cache(user_id):
+    favorites_generations.set(user_id, secrets.token_urlsafe(8))
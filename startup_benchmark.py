@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import urllib.request
+import urllib.error
+
+# 冷啟動測試：在子程序中重複量測 `import app` 的耗時，以及 `python app.py` 從啟動到 /health、/ready 回應 200 的時間
+# 沿用目前的環境變數（未設定 LINE 金鑰時使用假值），例如：
+#   python startup_benchmark.py --runs 5
+#   python startup_benchmark.py --importtime 15   （另外列出匯入最久的模組）
+# 外部服務沒有設定時 /ready 會一直回傳 503，此時只回報 /health 的時間與 /ready 最後的狀態
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+IMPORT_SCRIPT = "import time; start = time.perf_counter(); import app; print(time.perf_counter() - start)"
+
+
+def benchmark_env(**extra):
+    env = dict(os.environ)
+    env.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "startup-benchmark-token")
+    env.setdefault("LINE_CHANNEL_SECRET", "startup-benchmark-secret")
+    env.update(extra)
+    return env
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# 量測匯入 app 模組的時間（不啟動背景暖機，只計算匯入本身）
+def measure_import():
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT], cwd=ROOT, env=benchmark_env(WARM_UP_ON_IMPORT="0"),
+        capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+def get_status(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status, response.read().decode('utf-8')
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode('utf-8')
+    except OSError:
+        return None, None
+
+# 啟動 python app.py，輪詢 /health 與 /ready，回傳各自第一次回應 200 的秒數（逾時為 None）
+def measure_server(timeout, interval):
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "app.py"], cwd=ROOT, env=benchmark_env(PORT=str(port)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    result = {'health': None, 'ready': None, 'ready_status': None}
+    try:
+        while time.perf_counter() - start < timeout and process.poll() is None:
+            if result['health'] is None:
+                status, _ = get_status(f"{base}/health")
+                if status == 200:
+                    result['health'] = time.perf_counter() - start
+            if result['health'] is not None:
+                status, body = get_status(f"{base}/ready")
+                if status == 200:
+                    result['ready'] = time.perf_counter() - start
+                if body:
+                    result['ready_status'] = json.loads(body)
+                if status == 200 or (result['ready_status'] or {}).get('finished'):
+                    break
+            time.sleep(interval)
+    finally:
+        process.terminate()
+        process.wait()
+    return result
+
+# 以 -X importtime 找出 app 直接匯入的模組中耗時最久的幾個
+def import_profile(top):
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"], cwd=ROOT,
+        env=benchmark_env(WARM_UP_ON_IMPORT="0"), capture_output=True, text=True
+    ).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split('|')
+        # 每多一層巢狀匯入，名稱前多兩個空白；只列出 app 直接匯入的模組
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth != 1:
+            continue
+        modules.append((int(cumulative_us), int(self_us), name.strip()))
+    return sorted(modules, reverse=True)[:top]
+
+def summarize(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return {
+        'runs': len(values),
+        'median_ms': round(statistics.median(values) * 1000, 1),
+        'min_ms': round(min(values) * 1000, 1),
+        'max_ms': round(max(values) * 1000, 1),
+    }
+
+def print_summary(title, summary):
+    if summary is None:
+        print(f"{title:<20}{'未完成':>10}")
+    else:
+        print(f"{title:<20}{summary['median_ms']:>10}{summary['min_ms']:>10}{summary['max_ms']:>10}  ({summary['runs']} 次)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="量測 app 的匯入時間與啟動到 /health、/ready 可用的時間")
+    parser.add_argument("--runs", type=int, default=3, help="重複次數")
+    parser.add_argument("--timeout", type=float, default=60, help="等待單次啟動完成的上限（秒）")
+    parser.add_argument("--interval", type=float, default=0.02, help="輪詢間隔（秒）")
+    parser.add_argument("--importtime", type=int, default=0, help="列出 app 直接匯入的模組中最久的前 N 個")
+    parser.add_argument("--json", help="另外將結果寫入 JSON 檔")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    imports = [measure_import() for _ in range(args.runs)]
+    servers = [measure_server(args.timeout, args.interval) for _ in range(args.runs)]
+    report = {
+        'import': summarize(imports),
+        'health': summarize([server['health'] for server in servers]),
+        'ready': summarize([server['ready'] for server in servers]),
+        'last_ready_status': servers[-1]['ready_status'] if servers else None,
+    }
+    print(f"{'項目':<18}{'中位數(ms)':>10}{'最小':>8}{'最大':>8}")
+    print_summary("import app", report['import'])
+    print_summary("/health 200", report['health'])
+    print_summary("/ready 200", report['ready'])
+    if report['ready'] is None and report['last_ready_status']:
+        print(f"\n/ready 狀態: {json.dumps(report['last_ready_status'], ensure_ascii=False)}")
+    if args.importtime:
+        report['import_profile'] = [
+            {'module': name, 'cumulative_ms': round(cumulative / 1000, 1), 'self_ms': round(self_us / 1000, 1)}
+            for cumulative, self_us, name in import_profile(args.importtime)
+        ]
+        print(f"\n{'模組':<38}{'累計(ms)':>10}{'自身(ms)':>10}")
+        for row in report['import_profile']:
+            print(f"{row['module']:<40}{row['cumulative_ms']:>10}{row['self_ms']:>10}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
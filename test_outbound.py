@@ -0,0 +1,103 @@
+import time
+import asyncio
+import unittest
+from outbound import OutboundPolicy, CircuitBreaker, CircuitOpenError
+
+# 斷路器的 half-open 試探請求在執行前或執行中失敗時，之後仍要能在 reset_timeout 後恢復
+# 執行方式：python -m pytest test_outbound.py（或 python -m unittest test_outbound）
+
+RESET_TIMEOUT = 0.05
+
+
+class ServiceError(Exception):
+    pass
+
+
+def make_policy(rate=0, concurrency=4):
+    policy = OutboundPolicy("test", retryable=(ServiceError,), rate=rate, burst=1, concurrency=concurrency,
+                            retries=0, timeout=0.05)
+    policy.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=RESET_TIMEOUT)
+    return policy
+
+def fail():
+    raise ServiceError("服務錯誤")
+
+async def fail_async():
+    fail()
+
+async def succeed_async():
+    return "ok"
+
+def open_breaker(policy):
+    try:
+        policy.call(fail)
+    except ServiceError:
+        pass
+    assert policy.breaker.state == 'open'
+
+
+class CircuitBreakerRecoveryTest(unittest.TestCase):
+    def test_rate_limit_timeout_does_not_strand_half_open(self):
+        policy = make_policy(rate=1)
+        open_breaker(policy)
+        time.sleep(RESET_TIMEOUT)
+        # 令牌已在開啟斷路器的呼叫中用完，試探請求在限流等待時逾時，func 沒有執行
+        with self.assertRaises(TimeoutError):
+            policy.call(lambda: "ok")
+        self.assertNotEqual(policy.breaker.state, 'half-open')
+
+        policy.bucket.rate = 0
+        time.sleep(RESET_TIMEOUT)
+        self.assertEqual(policy.call(lambda: "ok"), "ok")
+        self.assertEqual(policy.breaker.state, 'closed')
+
+    def test_concurrency_timeout_does_not_strand_half_open(self):
+        policy = make_policy(concurrency=1)
+        open_breaker(policy)
+        time.sleep(RESET_TIMEOUT)
+        policy._semaphore.acquire()
+        try:
+            with self.assertRaises(TimeoutError):
+                policy.call(lambda: "ok")
+        finally:
+            policy._semaphore.release()
+        self.assertNotEqual(policy.breaker.state, 'half-open')
+
+        time.sleep(RESET_TIMEOUT)
+        self.assertEqual(policy.call(lambda: "ok"), "ok")
+        self.assertEqual(policy.breaker.state, 'closed')
+
+    def test_rejects_while_open(self):
+        policy = make_policy()
+        open_breaker(policy)
+        with self.assertRaises(CircuitOpenError):
+            policy.call(lambda: "ok")
+        self.assertEqual(policy.get_stats()['rejected'], 1)
+
+    def test_cancelled_async_probe_reopens(self):
+        async def scenario():
+            policy = make_policy()
+            try:
+                await policy.acall(fail_async)
+            except ServiceError:
+                pass
+            self.assertEqual(policy.breaker.state, 'open')
+            await asyncio.sleep(RESET_TIMEOUT)
+
+            # 試探請求執行中被取消，沒有回報結果
+            probe = asyncio.ensure_future(policy.acall(lambda: asyncio.sleep(10)))
+            await asyncio.sleep(0.01)
+            self.assertEqual(policy.breaker.state, 'half-open')
+            probe.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await probe
+            self.assertEqual(policy.breaker.state, 'open')
+
+            await asyncio.sleep(RESET_TIMEOUT)
+            self.assertEqual(await policy.acall(succeed_async), "ok")
+            self.assertEqual(policy.breaker.state, 'closed')
+        asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    unittest.main()